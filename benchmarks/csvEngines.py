@@ -0,0 +1,90 @@
+""" Compare the csv engines used to decode imported statements:
+
+    python -m benchmarks.csvEngines [--lines 1000000] [--quoted 0.5]
+
+    A statement is generated in a temporary file, read with the same
+    memory mapped reader as the import dialog, and decoded with each engine
+"""
+import os
+import gc
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+from pydosh.models import importModel
+
+# Account settings for the generated statement - date, description, credit, debit, sign, date format
+ACCOUNT_DATA = (0, 1, 2, 2, -1, 'dd/MM/yyyy')
+
+
+def writeStatement(filename, numLines, quotedRatio):
+    """ Write a statement of numLines records, with quotedRatio of them
+        having quoted descriptions and amounts
+    """
+    rand = random.Random(0)
+
+    with open(filename, 'w', encoding='ISO-8859-1') as f:
+        for line in range(numLines):
+            date = '%02d/%02d/%d' % (rand.randint(1, 28), rand.randint(1, 12), rand.randint(2010, 2020))
+            amount = rand.randint(-500000, 500000) / 100.0
+
+            if rand.random() < quotedRatio:
+                f.write('%s,"Company %d, Ltd","%s"\n' % (date, line % 5000, '{:,.2f}'.format(amount)))
+            else:
+                f.write('%s,Company %d,%.2f\n' % (date, line % 5000, amount))
+
+
+def timeit(function, *args, **kwargs):
+    """ Returns the seconds taken by the best of three calls, without
+        garbage collection (as the timeit module)
+    """
+    best = None
+
+    for _ in range(3):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import csv engines')
+    parser.add_argument('--lines', type=int, default=1000000, help='Number of records to generate')
+    parser.add_argument('--quoted', type=float, default=0.5, help='Ratio of records with quoted fields')
+    args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+
+    try:
+        writeStatement(filename, args.lines, args.quoted)
+
+        lines = importModel.MappedLines(filename)
+        for ends in lines.scan(100000):
+            lines.extend(ends)
+        lines = lines[:]
+
+        print('%d records, %d%% quoted' % (len(lines), 100 * args.quoted))
+        print('%-8s %10s %10s %14s' % ('engine', 'split (s)', 'decode (s)', 'records/s'))
+
+        for engine, split in sorted(importModel.csvEngines.items()):
+            splitTime = timeit(split, lines)
+            decodeTime = timeit(importModel.decodeRecords, lines, *ACCOUNT_DATA, engine=engine)
+            print('%-8s %10.2f %10.2f %14d' % (engine, splitTime, decodeTime, len(lines) / decodeTime))
+
+    finally:
+        os.remove(filename)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
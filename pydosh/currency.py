@@ -1,7 +1,32 @@
 import locale
+import logging
 import warnings
+import threading
+import functools
+import hashlib
+import json
 import os
 
+_log = logging.getLogger('pydosh.currency')
+
+# Value of a localeconv() entry that isn't set
+_CHAR_MAX = 127
+
+# Only one thread at a time can switch the locale to read its conventions
+_localeLock = threading.Lock()
+
+def _localeConv(loc):
+    """ Returns localeconv() for loc, restoring the current locale after.
+        locale.Error if loc isn't available
+    """
+    with _localeLock:
+        current = locale.setlocale(locale.LC_ALL)
+        try:
+            locale.setlocale(locale.LC_ALL, loc)
+            return locale.localeconv()
+        finally:
+            locale.setlocale(locale.LC_ALL, current)
+
 class _Locales(object):
     _locales=(
         'af_ZA.utf-8', 'am_ET.utf-8', 'be_BY.utf-8', 'bg_BG.utf-8', 'ca_ES.utf-8',
@@ -16,18 +41,190 @@ class _Locales(object):
         'sl_SI.utf-8', 'sv_SE.utf-8', 'tr_TR.utf-8', 'uk_UA.utf-8', 'zh_CN.utf-8',
         'zh_HK.utf-8', 'zh_TW.utf-8')
 
-    def __init__(self):
+
+    # Where the system keeps its compiled locales (locale-archive and a
+    # directory per locale) - if these change the cached currencies are
+    # found again. Not /usr/share/locale, which only has message catalogs
+    _localeDirs = ('/usr/lib/locale', '/usr/lib64/locale')
+
+    def __init__(self, cacheFile=None):
         super(_Locales, self).__init__()
-        self.currencyMap = {}
+        self._cacheFile = cacheFile or os.path.join(
+            os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pydosh', 'currencies.json')
+        self._lock = threading.Lock()
+        self._conventions = None
 
-        for loc in self._locales:
+    @property
+    def currencyMap(self):
+        """ Currency code to locale name
+        """
+        return dict((code, loc) for code, (loc, _) in self.__load().items())
+
+    @property
+    def conventions(self):
+        """ Currency code to the locale's localeconv()
+        """
+        return dict((code, conv) for code, (_, conv) in self.__load().items())
+
+    def __load(self):
+        """ Find the currencies on first use, from the cache file if
+            it was written for the same locales
+        """
+        with self._lock:
+            if self._conventions is None:
+                key = self.__cacheKey()
+                self._conventions = self.__readCache(key)
+
+                if self._conventions is None:
+                    self._conventions = self.__probe()
+                    self.__writeCache(key)
+
+        return self._conventions
+
+    def __cacheKey(self):
+        """ Returns a digest of the locales to probe and the state of the system's locale files
+        """
+        state = [list(self._locales)]
+
+        for path in self._localeDirs:
             try:
-                locale.setlocale(locale.LC_ALL, loc)
-                conv=locale.localeconv()
-                self.currencyMap[conv['int_curr_symbol'].strip()] = loc
+                state.append([path, os.stat(path).st_mtime_ns] + sorted(
+                    [entry.name, entry.stat().st_mtime_ns] for entry in os.scandir(path)))
+            except OSError:
+                pass
+
+        return hashlib.md5(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def __readCache(self, key):
+        try:
+            with open(self._cacheFile) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if cache.get('key') != key:
+            return None
 
+        return dict((code, tuple(value)) for code, value in cache['currencies'].items())
+
+    def __writeCache(self, key):
+        try:
+            os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+            with open(self._cacheFile, 'w') as f:
+                json.dump({'key': key, 'currencies': self._conventions}, f)
+        except OSError as exc:
+            _log.debug('Unable to write currency cache %s: %s', self._cacheFile, exc)
+
+    def __probe(self):
+        """ Returns a dict of currency code to (locale, localeconv()) for the available locales
+        """
+        conventions = {}
+
+        for loc in self._locales:
+            try:
+                conv = _localeConv(loc)
             except locale.Error:
-                pass
+                continue
+
+            conventions[conv['int_curr_symbol'].strip()] = (loc, conv)
+
+        return conventions
+
+class CurrencyFormatter(object):
+    """ Formats amounts for a currency as locale.currency(value, symbol=True, grouping=True),
+        but using the conventions (from localeconv) given here rather than
+        those of the current locale
+    """
+    def __init__(self, conv):
+        super(CurrencyFormatter, self).__init__()
+        self._digits = conv['frac_digits'] if conv['frac_digits'] != _CHAR_MAX else 2
+        self._decimalPoint = conv['mon_decimal_point'] or conv['decimal_point'] or '.'
+        self._thousandsSep = conv['mon_thousands_sep']
+        self._grouping = conv['mon_grouping']
+
+        # Text either side of the number for positive and negative amounts
+        self._positive = self.__affixes(conv, 'p', conv['positive_sign'])
+        self._negative = self.__affixes(conv, 'n', conv['negative_sign'])
+
+    @staticmethod
+    def __affixes(conv, prefix, sign):
+        """ Returns the (before, after) text for the sign's currency symbol and sign position
+        """
+        symbol = conv['currency_symbol']
+        separator = ' ' if conv[prefix + '_sep_by_space'] else ''
+        before, after = '<', '>'
+
+        if conv[prefix + '_cs_precedes']:
+            before = symbol + separator + before
+        else:
+            after = after + separator + symbol
+
+        signPosition = conv[prefix + '_sign_posn']
+
+        if signPosition == 0:
+            before, after = '(' + before, after + ')'
+        elif signPosition == 2:
+            after = after + sign
+        elif signPosition == 3:
+            before = before.replace('<', sign)
+        elif signPosition == 4:
+            after = after.replace('>', sign)
+        else:
+            before = sign + before
+
+        return before.replace('<', ''), after.replace('>', '')
+
+    def __intervals(self):
+        """ Generator of the sizes of the digit groups, from the right
+        """
+        last = None
+
+        for interval in self._grouping:
+            if interval == _CHAR_MAX:
+                return
+            elif interval == 0:
+                # Repeat the last size
+                while last:
+                    yield last
+                return
+
+            yield interval
+            last = interval
+
+    def __group(self, digits):
+        """ Insert the thousands separator into a string of digits
+        """
+        groups = []
+
+        for interval in self.__intervals():
+            if not digits:
+                break
+            groups.append(digits[-interval:])
+            digits = digits[:-interval]
+
+        if digits:
+            groups.append(digits)
+
+        return self._thousandsSep.join(reversed(groups))
+
+    def format(self, value):
+        """ Returns value formatted with the currency symbol and grouping
+        """
+        before, after = self._negative if value < 0 else self._positive
+        units, _, fraction = ('%.*f' % (self._digits, abs(value))).partition('.')
+        number = self.__group(units)
+
+        if fraction:
+            number += self._decimalPoint + fraction
+
+        return before + number + after
+
+@functools.lru_cache(maxsize=None)
+def formatter(currencyCode):
+    """ Returns the CurrencyFormatter for the currency code.
+        KeyError if the currency isn't known
+    """
+    return CurrencyFormatter(_locales.conventions[currencyCode])
 
 def formatCurrency(value):
     """ Returns the currency string with commans for a float value
@@ -41,20 +238,21 @@ def currencyCodes():
     """
     return list(_locales.currencyMap.keys())
 
+@functools.lru_cache(maxsize=None)
+def _currencyCode(lang):
+    return _localeConv(lang)['int_curr_symbol'].strip()
+
 def defaultCurrencyCode():
     """ Returns the local currency code (3 chars)
         eg:
             $LANG=en_GB.utf-8 -> 'GBP'
             $LANG=en_US.utf-8 -> 'USD'
     """
-    locale.setlocale(locale.LC_ALL, os.getenv('LANG'))
-    conv=locale.localeconv()
-    return conv['int_curr_symbol'].strip()
+    return _currencyCode(os.getenv('LANG') or '')
 
 def toCurrencyStr(value, currencyCode=None):
     try:
-        locale.setlocale(locale.LC_ALL, _locales.currencyMap[currencyCode or defaultCurrencyCode()])
-        return locale.currency(value, symbol=True, grouping=True)
+        return formatter(currencyCode or defaultCurrencyCode()).format(value)
     except (locale.Error, KeyError):
         warnings.warn('Failed to convert currency: current $LANG=%r' % os.getenv('LANG', ''))
         return formatCurrency(value)
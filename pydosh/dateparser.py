@@ -0,0 +1,101 @@
+import re
+import datetime
+import functools
+
+from PyQt5 import QtCore
+
+# Julian day of datetime.date ordinal 0
+_JULIAN_OFFSET = 1721425
+
+# Numeric Qt date format tokens and the regex to match them
+_TOKENS = (
+    ('yyyy', r'(?P<year>\d{4})'),
+    ('yy', r'(?P<shortYear>\d{2})'),
+    ('MM', r'(?P<month>\d{2})'),
+    ('M', r'(?P<month>\d{1,2})'),
+    ('dd', r'(?P<day>\d{2})'),
+    ('d', r'(?P<day>\d{1,2})'),
+)
+
+
+class DateParser(object):
+    """ Parses dates in a Qt date format (as used by QDate.fromString), returning
+        the julian day. Numeric formats are compiled to a regular expression,
+        anything else (eg month names) uses QDate. Results are memoized as
+        statements repeat the same dates many times
+    """
+    cacheSize = 4096
+
+    def __init__(self, dateFormat):
+        super(DateParser, self).__init__()
+        self._dateFormat = dateFormat
+        self._regex = self.__compile(dateFormat)
+        self.parse = functools.lru_cache(maxsize=self.cacheSize)(self.__parse)
+
+    def dateFormat(self):
+        return self._dateFormat
+
+    @staticmethod
+    def __compile(dateFormat):
+        """ Returns the compiled regex for the format, or None if
+            the format has more than numeric fields
+        """
+        pattern = ''
+        position = 0
+        seen = set()
+
+        while position < len(dateFormat):
+            for token, regex in _TOKENS:
+                if dateFormat.startswith(token, position):
+                    # Repeated fields, or a token running into the next, aren't simple
+                    name = token[0]
+                    if name in seen or dateFormat[position + len(token):position + len(token) + 1] == name:
+                        return None
+                    seen.add(name)
+                    pattern += regex
+                    position += len(token)
+                    break
+            else:
+                char = dateFormat[position]
+                if char.isalpha() or char == "'":
+                    return None
+                pattern += re.escape(char)
+                position += 1
+
+        if seen != set('yMd'):
+            return None
+
+        return re.compile(pattern)
+
+    def __parse(self, text):
+        """ Returns the julian day for text, or None if it's not a valid date
+        """
+        if self._regex is None:
+            date = QtCore.QDate.fromString(text, self._dateFormat)
+            return date.toJulianDay() if date.isValid() else None
+
+        match = self._regex.fullmatch(text)
+        if match is None:
+            return None
+
+        fields = match.groupdict()
+        year = int(fields['year']) if 'year' in fields else 1900 + int(fields['shortYear'])
+
+        try:
+            return datetime.date(year, int(fields['month']), int(fields['day'])).toordinal() + _JULIAN_OFFSET
+        except ValueError:
+            return None
+
+    def parseMany(self, texts):
+        """ Returns a list of julian days (or None) for texts, parsing
+            each distinct text only once
+        """
+        days = dict((text, self.parse(text)) for text in set(texts))
+        return [days[text] for text in texts]
+
+
+@functools.lru_cache(maxsize=None)
+def dateParser(dateFormat):
+    """ Returns the shared DateParser for dateFormat
+    """
+    return DateParser(dateFormat)
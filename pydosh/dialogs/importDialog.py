@@ -1,3 +1,4 @@
+from contextlib import closing
 from PyQt5 import QtCore, QtGui, QtSql, QtWidgets
 
 from pydosh import enum, currency
@@ -11,13 +12,19 @@ class UserCancelledException(Exception):
 
 
 class ImportDialog(Ui_Import, QtWidgets.QDialog):
+    # Minimum interval between view updates while loading or importing (20Hz)
+    updateInterval = 50
+
     def __init__(self, files, parent=None):
         super(ImportDialog, self).__init__(parent=parent)
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
         self.setupUi(self)
         self.__dataSaved = False
         self.__importInProgress = False
+        self.__loadInProgress = False
         self.__cancelImport = False
+        self.__updateTimer = QtCore.QElapsedTimer()
+        self.__updateTimer.start()
 
         self.progressBar.setVisible(False)
 
@@ -52,13 +59,20 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
 
         self.accountTypeComboBox.setCurrentIndex(-1)
 
-        model = ImportModel(files)
+        model = ImportModel(files, self)
 
         self.importCancelButton.setEnabled(False)
         self.selectAllButton.setEnabled(False)
         self.view.setModel(model)
         model.modelReset.connect(self.view.expandAll)
+        model.rowsInserted.connect(self.__recordsRead)
+        model.loadProgress.connect(self.progressBar.setValue)
+        model.loadFinished.connect(self.__loadFinished)
+        model.dataChanged.connect(self.__recordsFormatted)
+        model.formatFinished.connect(self.__formatFinished)
         self.view.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        # Records are one line - stops the view asking for every record's size
+        self.view.setUniformRowHeights(True)
         self.view.expandAll()
 
         selectionModel = self.view.selectionModel()
@@ -71,6 +85,57 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
 
         self.accountTypeComboBox.setCurrentIndex(0)
 
+        # Read the files in the background, with the import button used to cancel
+        self.__loadInProgress = True
+        self.progressBar.setMaximum(100)
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.importCancelButton.setText('Cancel')
+        self.importCancelButton.setEnabled(True)
+        model.loadInBackground()
+
+    def __recordsRead(self, parent, first, last):
+        """ Records have been read into the model - make sure they're visible
+        """
+        self.view.expand(parent)
+
+        if self.__updateDue():
+            self.__setCounters()
+
+    def __recordsFormatted(self):
+        """ Counters fill in as the records are decoded
+        """
+        if self.__updateDue():
+            self.__setCounters()
+
+    def __formatFinished(self):
+        self.__setCounters()
+        self.selectAllButton.setEnabled(self.__canSelectAll())
+
+    def __canSelectAll(self):
+        model = self.view.model()
+        return not self.__loadInProgress and not model.isFormatting() and bool(model.numRecordsToImport())
+
+    def __updateDue(self):
+        """ Returns True if the view hasn't been updated for updateInterval ms
+        """
+        if self.__updateTimer.hasExpired(self.updateInterval):
+            self.__updateTimer.restart()
+            return True
+        return False
+
+    def __loadFinished(self):
+        self.__loadInProgress = False
+        self.progressBar.setVisible(False)
+        self.importCancelButton.setText('Import')
+        self.__setCounters()
+
+        for column in range(self.view.model().columnCount()):
+            self.view.resizeColumnToContents(column)
+
+        self.selectAllButton.setEnabled(self.__canSelectAll())
+        self._recordsSelected()
+
     def _accountChanged(self, index):
         model = self.view.model()
         selection = self.accountTypeComboBox.itemData(index, QtCore.Qt.UserRole)
@@ -79,15 +144,18 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
         if selection is not None:
             selection = selection[1]
 
+        # Records are decoded as they're shown, and the rest in the background
         model.accountChanged(selection)
-        self.selectAllButton.setEnabled(bool(model.numRecordsToImport()))
+        self.selectAllButton.setEnabled(self.__canSelectAll())
         self.__setCounters()
 
         for column in range(model.columnCount()):
             self.view.resizeColumnToContents(column)
 
     def __importCancelPressed(self):
-        if self.__importInProgress:
+        if self.__loadInProgress:
+            self.view.model().cancelLoad()
+        elif self.__importInProgress:
             self.__cancelImport = True
         else:
             self.__importRecords()
@@ -103,7 +171,12 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
         """
         numSelected = len(self.view.selectionModel().selectedRows())
         self.selectedCounter.setNum(numSelected)
-        self.importCancelButton.setEnabled(bool(numSelected))
+        self.importCancelButton.setEnabled(self.__loadInProgress or bool(numSelected))
+
+    def done(self, result):
+        # Make sure the reader thread has stopped before we go
+        self.view.model().cancelLoad()
+        super(ImportDialog, self).done(result)
 
     def __close(self):
         """ Exit with bool value to indicate if data was saved,
@@ -111,6 +184,17 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
         """
         self.done(self.__dataSaved)
 
+    def __showImportProgress(self, indexes, num):
+        """ Update the view at most every updateInterval ms, but always
+            process events so cancel stays responsive
+        """
+        if self.__updateDue() or num == len(indexes):
+            self.view.scrollTo(indexes[num - 1], QtWidgets.QAbstractItemView.EnsureVisible)
+            self.__setCounters()
+            self.progressBar.setValue(num)
+
+        QtCore.QCoreApplication.processEvents()
+
     def __importRecords(self):
         """ Import selected rows to database
         """
@@ -147,28 +231,42 @@ class ImportDialog(Ui_Import, QtWidgets.QDialog):
             self.importCancelButton.setText('Cancel')
             self.importCancelButton.setEnabled(True)
 
-            # Wrap the import in a transaction
-            with db.transaction():
-                for num, index in enumerate(indexes, 1):
-                    model.saveRecord(accountId, currencyCode, index)
-                    self.view.scrollTo(index, QtWidgets.QAbstractItemView.EnsureVisible)
-                    self.__setCounters()
-                    QtCore.QCoreApplication.processEvents()
-                    self.progressBar.setValue(self.progressBar.value() +1)
+            # Commit every chunkSize records, or the whole import in one transaction
+            chunkSize = QtCore.QSettings().value('options/importchunksize', 0, type=int)
+
+            if chunkSize > 0:
+                num = 0
+                with closing(model.importRecords(accountId, currencyCode, indexes, chunkSize)) as chunks:
+                    for num in chunks:
+                        self.__dataSaved = True
+                        self.__showImportProgress(indexes, num)
 
-                    if self.__cancelImport:
-                        raise UserCancelledException
+                        if self.__cancelImport:
+                            raise UserCancelledException
 
                 if num:
-                    self.__dataSaved = True
-                    if QtWidgets.QMessageBox.question(
-                        self, 'Import', 'Imported %d records successfully' % num,
-                        QtWidgets.QMessageBox.Save|QtWidgets.QMessageBox.Cancel) != QtWidgets.QMessageBox.Save:
-                        # By raising here we will rollback the database transaction
-                        raise UserCancelledException
+                    QtWidgets.QMessageBox.information(
+                        self, 'Import', 'Imported %d records successfully' % num)
+            else:
+                with db.transaction():
+                    num = 0
+                    for num in model.saveRecords(accountId, currencyCode, indexes):
+                        self.__showImportProgress(indexes, num)
+
+                        if self.__cancelImport:
+                            raise UserCancelledException
+
+                    if num:
+                        self.__dataSaved = True
+                        if QtWidgets.QMessageBox.question(
+                            self, 'Import', 'Imported %d records successfully' % num,
+                            QtWidgets.QMessageBox.Save|QtWidgets.QMessageBox.Cancel) != QtWidgets.QMessageBox.Save:
+                            # By raising here we will rollback the database transaction
+                            raise UserCancelledException
 
         except UserCancelledException:
-            self.__dataSaved = False
+            # Chunks that have been committed stay imported
+            self.__dataSaved = self.__dataSaved and chunkSize > 0
             model.reset()
 
         except Exception as exc:
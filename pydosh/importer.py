@@ -0,0 +1,142 @@
+""" Command line bulk importer, for loading statements without the UI:
+
+    pydosh-import --account "Natwest current" statement1.csv statement2.csv
+
+    The database connection uses the settings saved by the pydosh login dialog
+"""
+import sys
+import time
+import logging
+import argparse
+from PyQt5 import QtCore, QtSql
+
+from pydosh import currency
+from pydosh.database import db, ConnectionException, DatabaseNotInitialisedException
+from pydosh.models import ImportModel
+from pydosh.models.importModel import ImportException
+
+
+class ImporterError(Exception):
+    """ Errors that stop the import
+    """
+
+
+def accountSettings(accountName):
+    """ Returns the account id and decoding settings for accountName,
+        as used by ImportModel.accountChanged
+    """
+    query = QtSql.QSqlQuery()
+    query.prepare("""
+            SELECT a.id, at.datefield, at.descriptionfield, at.creditfield,
+                   at.debitfield, at.currencysign, at.dateformat
+              FROM accounts a
+        INNER JOIN accounttypes at
+                ON at.accounttypeid=a.accounttypeid
+             WHERE a.userid=?
+               AND a.name=?
+        """)
+    query.addBindValue(db.userId)
+    query.addBindValue(accountName)
+
+    if not query.exec_():
+        raise ImporterError(query.lastError().text())
+
+    if not query.next():
+        raise ImporterError('No account named %r' % accountName)
+
+    return query.value(0), tuple(query.value(column) for column in range(1, 7))
+
+
+def importFiles(files, accountName, currencyCode, chunkSize=0, out=sys.stdout):
+    """ Import records from files, writing the statistics to out. If chunkSize
+        is set, every chunkSize records are committed separately and an
+        interrupted import is resumed by running it again
+    """
+    accountId, accountData = accountSettings(accountName)
+
+    start = time.time()
+    model = ImportModel(files)
+    model.load()
+    model.accountChanged(accountData)
+    model.formatPending()
+
+    numRecords = model.numRecords()
+    numBad = model.numBadRecords()
+    numDuplicates = model.numDuplicateRecords()
+    numAlreadyImported = model.numRecordsImported()
+    indexes = model.recordsToImport()
+    readTime = time.time() - start
+
+    out.write('Read %d records from %d files in %.1fs (%d records/s)\n' % (
+        numRecords, len(files), readTime, numRecords / max(readTime, 0.001)))
+
+    start = time.time()
+    numImported = 0
+
+    if chunkSize > 0:
+        batch = model.resumableBatch(accountId)
+        if batch is not None:
+            out.write('Resuming import from %s\n' % batch.toString(QtCore.Qt.ISODate))
+
+        for numImported in model.importRecords(accountId, currencyCode, indexes, chunkSize):
+            pass
+    else:
+        with db.transaction():
+            for numImported in model.saveRecords(accountId, currencyCode, indexes):
+                pass
+
+    saveTime = time.time() - start
+
+    out.write('Imported %d records in %.1fs (%d records/s)\n' % (
+        numImported, saveTime, numImported / max(saveTime, 0.001)))
+    out.write('Already imported: %d\n' % numAlreadyImported)
+    out.write('Duplicates in files: %d\n' % numDuplicates)
+    out.write('Bad records: %d\n' % numBad)
+
+    return numImported
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='pydosh-import', description='Import bank statements into pydosh')
+    parser.add_argument('files', nargs='+', help='CSV files to import')
+    parser.add_argument('-a', '--account', required=True, help='Account name')
+    parser.add_argument('-c', '--currency', help='Currency code (default from $LANG)')
+    parser.add_argument('-s', '--chunk-size', type=int, default=0,
+                        help='Commit every CHUNK_SIZE records (default is a single transaction)')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debug')
+    args = parser.parse_args()
+
+    app = QtCore.QCoreApplication(sys.argv)
+
+    QtCore.QCoreApplication.setApplicationName("pydosh")
+    QtCore.QCoreApplication.setOrganizationName("innerhippy")
+    QtCore.QCoreApplication.setOrganizationDomain("innerhippy.com")
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.DEBUG if args.debug else logging.ERROR
+    )
+
+    currencyCode = args.currency or currency.defaultCurrencyCode()
+
+    try:
+        db.connect()
+        importFiles(args.files, args.account, currencyCode, args.chunk_size)
+
+    except DatabaseNotInitialisedException:
+        sys.stderr.write('Database %s is not initialised - run pydosh first\n' % db.database)
+        return 1
+
+    except (ConnectionException, ImporterError, ImportException, IOError) as exc:
+        sys.stderr.write('%s\n' % exc)
+        return 1
+
+    except Exception as exc:
+        # Database errors from the model
+        sys.stderr.write('Import failed: %s\n' % exc)
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
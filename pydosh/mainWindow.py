@@ -1,5 +1,4 @@
 from PyQt5 import QtGui, QtCore, QtSql, Qt, QtWidgets
-from contextlib import contextmanager
 import operator
 import logging
 import re
@@ -74,15 +73,13 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
 
         # Set up record model
         recordModel = models.RecordModel(self)
-        recordModel.setTable('records')
-        recordModel.setEditStrategy(QtSql.QSqlTableModel.OnFieldChange)
         recordProxyModel = models.RecordProxyModel(self)
 
-        # "you should not update the source model through
-        #  the proxy model when dynamicSortFilter is true"
-        recordProxyModel.setDynamicSortFilter(False)
         recordProxyModel.setSourceModel(recordModel)
 
+        settings = QtCore.QSettings()
+        recordProxyModel.setServerSideFiltering(settings.value('options/serverfilter', False, type=bool))
+
         self.tableView.setModel(recordProxyModel)
         recordModel.select()
 
@@ -141,12 +138,13 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
         self.removeTagButton.clicked.connect(self.removeTagClicked)
         self.recPlotButton.clicked.connect(self.recPlot)
         recordModel.dataChanged.connect(self.updateTagFilter)
+        recordModel.readError.connect(self.showDatabaseError, QtCore.Qt.QueuedConnection)
         recordProxyModel.filterChanged.connect(self.updateTagFilter)
         recordProxyModel.modelReset.connect(self.updateTagFilter)
         selectionModel = self.tableView.selectionModel()
         selectionModel.selectionChanged.connect(self.recordSelectionChanged)
         self.tableView.customContextMenuRequested.connect(self.tagEditPopup)
-        tagModel.tagsChanged.connect(self.tagModelChanged)
+        tagModel.recordTagsChanged.connect(self.recordTagsChanged)
         tagModel.selectionChanged.connect(recordProxyModel.setTagFilter)
         selectionModel = self.tagView.selectionModel()
         selectionModel.selectionChanged.connect(self.tagSelectionChanged)
@@ -416,44 +414,14 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
                     QtWidgets.QMessageBox.critical(self, 'Database Error',
                         proxyModel.sourceModel().lastError().text(), QtWidgets.QMessageBox.Ok)
 
+                # Tag totals once for all the deleted rows
+                self.updateTagFilter()
+
                 # Finally, re-populate accounts and date range in case this has changed
                 self.populateAccounts()
                 self.populateDates()
                 self.setDateRange()
 
-    @contextmanager
-    def keepSelection(self):
-        """ Context manager to preserve table selection. This is usually required
-            when calling select on the model - as this causes a reset of the model.
-
-            There should be a better way of doing this, but the only accurate means
-            of determining what rows were selected is by saving the recordIds before
-            the yield, and then restoring them with a call to match.
-        """
-        try:
-            # Save selection
-            selectedRecords = self.selectedRecordIds()
-            selectionMode = self.tableView.selectionMode()
-            yield
-        finally:
-            # Set this temporarily so that we can select more than one row
-            self.tableView.setSelectionMode(QtWidgets.QAbstractItemView.MultiSelection)
-            proxyModel = self.tableView.model()
-
-            for recordId in selectedRecords:
-                currentIndex = proxyModel.sourceModel().index(0, enum.kRecords_RecordId)
-                match = proxyModel.sourceModel().match(currentIndex, QtCore.Qt.DisplayRole, recordId, 1, QtCore.Qt.MatchExactly)
-                if match:
-                    self.tableView.selectRow(proxyModel.mapFromSource(match[0]).row())
-
-            self.tableView.setSelectionMode(selectionMode)
-
-            selected = self.tableView.selectionModel().selectedRows()
-
-            # Scroll to first selected row
-            if selected:
-                self.tableView.scrollTo(selected[0], QtWidgets.QAbstractItemView.EnsureVisible)
-
     def populateAccounts(self):
         """ Populate account data for the current user
         """
@@ -508,8 +476,7 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
         proxyModel = self.tableView.model()
         modelIndexes = [proxyModel.mapToSource(index) for index in selectionModel.selectedRows()]
 
-        with self.keepSelection():
-            proxyModel.sourceModel().toggleChecked(modelIndexes)
+        proxyModel.sourceModel().toggleChecked(modelIndexes)
 
     @utils.showWaitCursorDecorator
     def reset(self, *args):
@@ -580,6 +547,12 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
         action.setStatusTip('User Account setup')
         action.triggered.connect(self.accountsDialog)
 
+        action = menu.addAction('&Server-side filtering')
+        action.setCheckable(True)
+        action.setChecked(QtCore.QSettings().value('options/serverfilter', False, type=bool))
+        action.setStatusTip('Filter records in the database and read them as the view scrolls')
+        action.toggled.connect(self.setServerSideFiltering)
+
         styleMenu = menu.addMenu(QtGui.QIcon(':/icons/brush.png'), 'Style')
         for style in stylesheet.styleSheetNames():
             styleMenu.addAction(style, self.setStyle)
@@ -594,6 +567,15 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
         action.setStatusTip('About')
         action.triggered.connect(self.showAbout)
 
+    def setServerSideFiltering(self, enabled):
+        """ Triggered from menu action to switch between filtering records
+            in memory or in the database
+        """
+        settings = QtCore.QSettings()
+        settings.setValue('options/serverfilter', enabled)
+        self.tableView.model().setServerSideFiltering(enabled)
+        self.reset()
+
     def setStyle(self):
         """ Triggered from menu action when user selects a style/theme
         """
@@ -605,49 +587,55 @@ class PydoshWindow(Ui_pydosh, QtWidgets.QMainWindow):
         icon = ':/icons/graph-white.png' if stylesheet.isDark() else ':/icons/graph-black.png'
         self.recPlotButton.setIcon(QtGui.QIcon(icon))
 
-    def displayRecordCount(self):
-        inTotal = 0.0
-        outTotal = 0.0
+    def showDatabaseError(self, text):
+        QtWidgets.QMessageBox.critical(self, 'Database Error', text, QtWidgets.QMessageBox.Ok)
 
+    def displayRecordCount(self):
         model = self.tableView.model()
-        for row in range(model.rowCount()):
-            amount = model.index(row, enum.kRecords_Amount).data(QtCore.Qt.UserRole)
-            if amount > 0.0:
-                inTotal += amount
-            else:
-                outTotal += abs(amount)
+
+        if model.isServerSideFiltering():
+            # Only some of the matching records have been read - get the totals from the database
+            try:
+                numRecords, numFiltered, inTotal, outTotal = model.sourceModel().filterTotals()
+            except Exception as exc:
+                _log.error('Failed to read record totals: %s', exc)
+                return
+        else:
+            inTotal, outTotal = model.totals()
+            numFiltered = model.rowCount()
+            numRecords = model.sourceModel().rowCount()
 
         self.inTotalLabel.setText(currency.toCurrencyStr(inTotal))
         self.outTotalLabel.setText(currency.toCurrencyStr(outTotal))
         self.netTotalLabel.setText(currency.toCurrencyStr(inTotal - outTotal))
-        self.recordCountLabel.setText(
-            '%d / %d' % (
-                model.rowCount(),
-                self.tableView.model().sourceModel().rowCount()
-            )
-        )
+        self.recordCountLabel.setText('%d / %d' % (numFiltered, numRecords))
 
-    def tagModelChanged(self):
-        """ Tag model has changed - call select on record model to refresh the changes (in tag column)
-            Note: calling setFilter is a bad idea as we'll enter circular hell
+    def recordTagsChanged(self, recordIds):
+        """ Tags have been assigned to or removed from records - only these
+            records need to be refreshed in the record model
         """
-        with self.keepSelection():
-            self.tableView.model().sourceModel().select()
+        self.tableView.model().sourceModel().refreshRecords(recordIds)
 
     @utils.showWaitCursorDecorator
     def updateTagFilter(self, *args):
         """ Tell the tag model to limit tag amounts to current displayed records
         """
         _log.debug('updateTagFilter')
-        recordIds = []
         model = self.tableView.model()
+        tagModel = self.tagView.model().sourceModel()
+
+        if model.isServerSideFiltering():
+            # Only some of the matching records have been read - get the totals from the database
+            try:
+                tagModel.setRecordFilterClause(*model.filterClause())
+            except Exception as exc:
+                # Same filter as the records, which has already been reported
+                _log.error('Failed to read tag totals: %s', exc)
+        else:
+            mask = model.filterMask()
+            _log.debug("tag filter using %d records", mask.sum())
+            tagModel.setRecordFilter(model.sourceModel().store(), mask)
 
-        for i in range(model.rowCount()):
-            recordIds.append(model.index(i, enum.kRecords_RecordId).data())
-
-        _log.debug("tag filter using %d records", len(recordIds))
-
-        self.tagView.model().sourceModel().setRecordFilter(recordIds)
         self.tagView.resizeColumnsToContents()
         self.displayRecordCount()
 
@@ -1,14 +1,28 @@
 import re
 import os
+import sys
 import csv
+import math
+import functools
+import array
+import atexit
+import logging
 import hashlib
-import codecs
+import mmap
+import multiprocessing
+import concurrent.futures
+import numpy as np
 
 from PyQt5 import QtCore, QtGui, QtSql
 
-from pydosh import utils, enum
+from pydosh import enum
+from pydosh.dateparser import dateParser
 from pydosh.database import db
 
+_log = logging.getLogger('pydosh.importModel')
+
+NAN = float('nan')
+
 class DecoderError(Exception):
     """ General Decoder exceptions
     """
@@ -21,6 +35,7 @@ class TreeItem(object):
     def __init__(self):
         super(TreeItem, self).__init__()
         self._parent = None
+        self._row = 0
         self._error = None
         self._imported = False
         self._duplicate = False
@@ -74,6 +89,15 @@ class TreeItem(object):
             num += child.numRecordsImported()
         return num
 
+    def numDuplicateRecords(self):
+        """ Returns the number of valid records repeated in the files, that
+            haven't already been imported
+        """
+        num = int(self._duplicate and not self._imported and self.isValid())
+        for child in self._children:
+            num += child.numDuplicateRecords()
+        return num
+
     def numBadRecords(self):
         """ Returns total number of bad records in tree model
         """
@@ -86,6 +110,12 @@ class TreeItem(object):
         for child in self._children:
             child.formatItem(dateField, descriptionField, creditField, debitField, currencySign, dateFormat)
 
+    def setFormat(self, accountData):
+        """ Set the account data used to decode records as they're needed
+        """
+        for child in self._children:
+            child.setFormat(accountData)
+
     def reset(self):
         for child in self._children:
             child.reset()
@@ -98,6 +128,7 @@ class TreeItem(object):
 
     def appendChild(self, child):
         child.setParent(self)
+        child._row = len(self._children)
         self._children.append(child)
 
     def child(self, row):
@@ -120,12 +151,12 @@ class TreeItem(object):
         return self._parent
 
     def indexOf(self, child):
-        return self._children.index(child)
+        return child.row()
 
     def row(self):
-        if self._parent:
-            return self._parent.indexOf(self)
-        return 0
+        """ Position of the item in its parent, as set by appendChild
+        """
+        return self._row
 
     def canImport(self):
         return False
@@ -133,10 +164,399 @@ class TreeItem(object):
     def isSelectable(self):
         return False
 
+def recordChecksum(rawData):
+    """ Returns the md5 digest of the raw record. This is stored in the
+        database as a hex string
+    """
+    return hashlib.md5(rawData.encode('utf-8')).digest()
+
+class ChecksumSet(object):
+    """ The record checksums seen so far, used to find duplicate records.
+        Checksums are held in sorted numpy arrays of 16 byte values rather
+        than a bytes object each. A batch is added as a new run, and runs
+        are merged while the one before is less than twice the size, so
+        there are only a few runs to search. Each run is searched on the
+        first 8 bytes of its checksums as integers, which is much quicker
+        than comparing the byte strings
+    """
+    dtype = np.dtype('V16')
+
+    def __init__(self):
+        self._runs = []
+
+    def __len__(self):
+        return sum(len(run) for _, run in self._runs)
+
+    @staticmethod
+    def keys(checksums):
+        """ Returns the first 8 bytes of checksums (an array of dtype) as integers,
+            which sort in the same order as the checksums
+        """
+        return checksums.view('>u8')[::2].astype(np.uint64)
+
+    def contains(self, checksums):
+        """ Returns a bool array of which of checksums (an array of dtype) are in the set
+        """
+        found = np.zeros(len(checksums), dtype=bool)
+        keys = self.keys(checksums)
+
+        for runKeys, run in self._runs:
+            positions = np.minimum(np.searchsorted(runKeys, keys), len(run) - 1)
+            found |= run[positions] == checksums
+
+            # Other checksums in the run may start with the same 8 bytes
+            for index in np.flatnonzero(~found & (runKeys[positions] == keys)):
+                last = np.searchsorted(runKeys, keys[index], 'right')
+                found[index] = (run[positions[index]:last] == checksums[index]).any()
+
+        return found
+
+    def add(self, checksums):
+        """ Add a batch of checksums (a list of digests). Returns a bool array of
+            those already in the set or repeated earlier in the batch
+        """
+        checksums = np.frombuffer(b''.join(checksums), dtype=self.dtype)
+        unique, first = np.unique(checksums, return_index=True)
+
+        duplicate = self.contains(checksums)
+        repeated = np.ones(len(checksums), dtype=bool)
+        repeated[first] = False
+        new = unique[~duplicate[first]]
+
+        if len(new):
+            self._runs.append((self.keys(new), new))
+
+        while len(self._runs) > 1 and len(self._runs[-2][1]) < 2 * len(self._runs[-1][1]):
+            run = np.concatenate([run for _, run in self._runs[-2:]])
+            # Merges the two sorted runs
+            run.sort(kind='stable')
+            self._runs[-2:] = [(self.keys(run), run)]
+
+        return duplicate | repeated
+
+def splitFields(line):
+    """ Split a line of csv data into fields. The csv module is only
+        needed if there are quoted values
+    """
+    if '"' in line:
+        return next(csv.reader([line]))
+    return line.split(',')
+
+def splitLines(lines):
+    """ Split each line on its own
+    """
+    return [splitFields(line) for line in lines]
+
+def readLines(lines):
+    """ Split all the lines with a single csv reader, or just on commas
+        if none of them have quotes
+    """
+    if not any('"' in line for line in lines):
+        return [line.split(',') for line in lines]
+
+    records = list(csv.reader(lines))
+
+    if len(records) != len(lines):
+        # A quote that isn't closed runs on to the next line
+        return splitLines(lines)
+
+    return records
+
+# Functions to split lines of csv data into fields, by name
+csvEngines = {
+    'line': splitLines,
+    'csv': readLines,
+}
+
+defaultCsvEngine = 'csv'
+
+@functools.lru_cache(maxsize=4096)
+def cachedFields(line):
+    """ Fields of the lines being displayed - the view asks for each
+        column in turn, so don't split the line every time
+    """
+    return tuple(splitFields(line))
+
+# Characters of a plain number, and anything else to remove from an amount
+_AMOUNT_CHARS = '0123456789.-'
+_AMOUNT_JUNK = re.compile(r'[^\d.-]')
+
+def roundCents(amounts):
+    """ Returns a NumPy array of amounts as whole cents, rounded half away
+        from zero as the database rounds them into numeric(15,2). Cents are
+        rounded to 6 places first, as 12.345 * 100 is 1234.4999... as a float
+    """
+    cents = np.floor(np.round(np.abs(amounts) * 100, 6) + 0.5)
+    return (np.sign(amounts) * cents).astype(np.int64)
+
+def parseAmounts(fields):
+    """ Parse a column of amount fields, returning a NumPy array of cents
+        and a mask of the fields that held a valid amount.
+
+        Each distinct field is parsed once. Plain numbers are converted
+        together, only the rest are sanitised to remove any currency sign
+        or other junk
+    """
+    if not fields:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    # Dict rather than np.unique, as sorting strings is slow
+    codes = {}
+    inverse = np.fromiter((codes.setdefault(field, len(codes)) for field in fields), dtype=np.intp, count=len(fields))
+    uniques = np.array(list(codes), dtype=object)
+    amounts = np.full(len(uniques), np.nan)
+
+    # Blank and sign only fields (eg an empty credit column) aren't numbers, so
+    # leave them to the sanitised parse rather than fail the vectorised one
+    plain = np.array([not field.strip(_AMOUNT_CHARS) and bool(field.strip('.-')) for field in uniques], dtype=bool)
+
+    try:
+        amounts[plain] = uniques[plain].astype(str).astype(np.float64)
+    except ValueError:
+        # Something like '-' or '1.2.3', so do these one at a time
+        plain[:] = False
+
+    for position in np.flatnonzero(~plain):
+        try:
+            amounts[position] = float(_AMOUNT_JUNK.sub('', uniques[position]))
+        except ValueError:
+            pass
+
+    valid = np.isfinite(amounts)
+    cents = np.zeros(len(uniques), dtype=np.int64)
+    cents[valid] = roundCents(amounts[valid])
+
+    return cents[inverse], valid[inverse]
+
+def decodeRecords(lines, dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat,
+                  engine=defaultCsvEngine):
+    """ Decode lines of csv data for an account, splitting them with the named
+        csv engine. Returns NumPy arrays of julian days (CsvFileItem.kNoDate
+        if not decoded), credits and debits (NaN if none) and a dict of line
+        number to error.
+
+        This is run by the format pool, so must only depend on its arguments
+    """
+    dates = np.full(len(lines), CsvFileItem.kNoDate, dtype=np.int64)
+    credits = np.full(len(lines), np.nan)
+    debits = np.full(len(lines), np.nan)
+    errors = {}
+
+    rows = []
+    records = []
+    maxIdx = max(dateIdx, descriptionIdx, creditIdx, debitIdx)
+
+    nonEmpty = [row for row, line in enumerate(lines) if line]
+
+    for row, fields in zip(nonEmpty, csvEngines[engine]([lines[row] for row in nonEmpty])):
+        if maxIdx > len(fields) - 1:
+            errors[row] = 'Bad Record'
+        else:
+            rows.append(row)
+            records.append(fields)
+
+    days = dateParser(dateFormat).parseMany([fields[dateIdx] for fields in records])
+    datedRows = []
+    datedRecords = []
+
+    for row, fields, day in zip(rows, records, days):
+        if day is None:
+            errors[row] = 'Invalid date: %r' % fields[dateIdx]
+        else:
+            dates[row] = day
+            datedRows.append(row)
+            datedRecords.append(fields)
+
+    rows = np.array(datedRows, dtype=np.intp)
+    debitCents, isDebit = parseAmounts([fields[debitIdx] for fields in datedRecords])
+
+    if debitIdx == creditIdx:
+        # Use currency multiplier to ensure that credit is +ve (money in),
+        # debit -ve (money out)
+        amounts = debitCents * currencySign
+        isCredit = isDebit & (amounts > 0)
+        isDebit &= amounts <= 0
+        credits[rows[isCredit]] = amounts[isCredit] / 100.0
+        debits[rows[isDebit]] = amounts[isDebit] / 100.0
+    else:
+        creditCents, isCredit = parseAmounts([fields[creditIdx] for fields in datedRecords])
+        isCredit &= creditCents != 0
+        isDebit &= debitCents != 0
+        credits[rows[isCredit]] = np.abs(creditCents[isCredit]) / 100.0
+        debits[rows[isDebit]] = np.abs(debitCents[isDebit]) / -100.0
+
+    noAmount = (np.nan_to_num(credits[rows]) == 0) & (np.nan_to_num(debits[rows]) == 0)
+
+    for row in rows[noAmount]:
+        errors[int(row)] = 'No credit or debit found'
+
+    return dates, credits, debits, errors
+
+def _toArray(typecode, values):
+    """ Convert a NumPy array to an array.array of typecode
+    """
+    result = array.array(typecode)
+    result.frombytes(np.asarray(values, dtype=typecode).tobytes())
+    return result
+
+_formatPool = None
+
+def formatPool():
+    """ Returns the process pool used to decode large files, or
+        None if one can't be created
+    """
+    global _formatPool
+
+    if _formatPool is None and getattr(sys, 'frozen', False):
+        # Spawning workers would start another copy of the app bundle
+        _formatPool = False
+
+    if _formatPool is None:
+        try:
+            # Don't fork a process that's running Qt threads
+            _formatPool = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_formatPool.shutdown)
+        except (OSError, ValueError, NotImplementedError) as exc:
+            _log.warning('Unable to start format pool: %s', exc)
+            _formatPool = False
+
+    return _formatPool or None
+
+def discardFormatPool():
+    """ Stop using the format pool after it has failed
+    """
+    global _formatPool
+
+    if _formatPool:
+        _formatPool.shutdown(wait=False)
+
+    _formatPool = False
+
+class MappedLines(object):
+    """ The lines of a file, read through a memory map. Only the offsets of
+        the lines are held, and a line is decoded each time it's asked for
+    """
+    # Number of bytes to search for line ends at a time
+    scanSize = 16 * 1024 * 1024
+
+    def __init__(self, filename):
+        super(MappedLines, self).__init__()
+        # Line n runs from _bounds[n] up to _bounds[n + 1]
+        self._bounds = array.array('q', [0])
+
+        with open(filename, 'rb') as f:
+            # An empty file can't be mapped
+            if os.fstat(f.fileno()).st_size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._map = b''
+
+    def __len__(self):
+        return len(self._bounds) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.__line(row) for row in range(*key.indices(len(self)))]
+
+        if key < 0:
+            key += len(self)
+
+        if not 0 <= key < len(self):
+            raise IndexError('line index out of range')
+
+        return self.__line(key)
+
+    def __iter__(self):
+        return (self.__line(row) for row in range(len(self)))
+
+    def __line(self, row):
+        return self._map[self._bounds[row]:self._bounds[row + 1]].decode('ISO-8859-1').strip()
+
+    def size(self):
+        return len(self._map)
+
+    def extend(self, ends):
+        """ Add lines, given the offset of the end of each line
+        """
+        self._bounds.extend(int(end) for end in ends)
+
+    def scan(self, batchSize):
+        """ Generator to find the lines after those already added. Yields
+            an array of the end offsets of up to batchSize lines at a time
+        """
+        size = len(self._map)
+        position = self._bounds[-1]
+
+        if position >= size:
+            return
+
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        ends = np.empty(0, dtype=np.int64)
+
+        while position < size:
+            block = data[position:position + self.scanSize]
+            ends = np.concatenate((ends, np.flatnonzero(block == ord('\n')) + position + 1))
+            position += len(block)
+
+            # The last line might not have a newline
+            if position == size and (not len(ends) or ends[-1] != size):
+                ends = np.append(ends, size)
+
+            while len(ends) >= batchSize or (position == size and len(ends)):
+                yield ends[:batchSize]
+                ends = ends[batchSize:]
+
+        # Release the buffer so the map can be closed
+        del data, block
+
 class CsvFileItem(TreeItem):
+    """ A csv file and its records. The records are held in parallel arrays
+        rather than as an item each, and CsvRecordItem handles are created
+        only when they are asked for
+    """
+    # Record status flags
+    kImported = 0x01
+    kDuplicate = 0x02
+    kEmpty = 0x04
+
+    # Julian day for a record with no date
+    kNoDate = 0
+
+    # Minimum number of records to decode with the format pool
+    parallelFormatThreshold = 20000
+
+    # Number of records decoded together when formatting on demand
+    formatBlockSize = 1024
+
+    # Values of _pendingBlocks - a pending block may have been submitted to the format pool
+    kBlockDone = 0
+    kBlockPending = 1
+    kBlockSubmitted = 2
+
     def __init__(self, filename):
         super(CsvFileItem, self).__init__()
         self._filename = filename
+        self._formatted = False
+        self._accountData = None
+        self._pendingBlocks = bytearray()
+        self._futures = {}
+        self._csvEngine = defaultCsvEngine
+        self._descriptionIdx = None
+        self._maxFields = 0
+        self._rawData = []
+        self._checksums = bytearray()
+        self._status = bytearray()
+        self._dates = array.array('l')
+        self._credits = array.array('d')
+        self._debits = array.array('d')
+        self._errors = {}
+
+        # Counters, kept up to date as record status changes
+        self._numBadRecords = 0
+        self._numRecordsImported = 0
+        self._numRecordsToImport = 0
+        self._numDuplicateRecords = 0
 
     def columnCount(self):
         return 1
@@ -145,62 +565,484 @@ class CsvFileItem(TreeItem):
         if role == QtCore.Qt.DisplayRole and column == 0:
             return os.path.basename(self._filename)
 
+    def appendRecords(self, lines, checksums=None):
+        """ Add records from lines of raw csv data, with their
+            checksums if already calculated
+        """
+        self._rawData.extend(lines)
+        self.__appended(lines, checksums)
+
+    def appendLines(self, ends, checksums=None, flags=None):
+        """ Add records from the lines of the file that end at the offsets
+            ends. The file is memory mapped, and its lines are only decoded
+            when they're needed. flags are the kImported and kDuplicate
+            status of each line, if known
+        """
+        if not isinstance(self._rawData, MappedLines):
+            self._rawData = MappedLines(self._filename)
+
+        first = len(self._rawData)
+        self._rawData.extend(ends)
+        self.__appended(self._rawData[first:], checksums, flags)
+
+    def __appended(self, lines, checksums, flags=None):
+        """ Extend the record data for lines added to the raw data
+        """
+        numLines = len(lines)
+        self._checksums.extend(b''.join(checksums or [recordChecksum(line) for line in lines]))
+        self._status.extend(bytes(
+            (self.kEmpty if not line else 0) | flag for line, flag in zip(lines, flags or [0] * numLines)))
+        self._dates.extend([self.kNoDate] * numLines)
+        self._credits.extend([NAN] * numLines)
+        self._debits.extend([NAN] * numLines)
+
+        for row in range(len(self._rawData) - numLines, len(self._rawData)):
+            self.__count(row, 1)
+
+        if self._accountData is not None:
+            self.__setPending(len(self._rawData) - numLines, len(self._rawData))
+
+        for line in lines:
+            # Only need the csv module to count the fields if there are quoted values
+            numFields = len(splitFields(line)) if '"' in line else line.count(',') + 1
+            self._maxFields = max(self._maxFields, numFields)
+
+    def childCount(self):
+        return len(self._rawData)
+
+    def child(self, row):
+        """ Returns a CsvRecordItem for row
+        """
+        return CsvRecordItem(parent=self, row=row)
+
+    def children(self):
+        return (self.child(row) for row in range(self.childCount()))
+
+    def maxColumns(self):
+        if not self._rawData:
+            return self.columnCount()
+        elif not self._formatted:
+            return max(self.columnCount(), self._maxFields)
+        elif len(self._errors) == len(self._rawData):
+            return 1
+        return 6
+
+    def fields(self, row):
+        return cachedFields(self._rawData[row])
+
+    def rawData(self, row):
+        return self._rawData[row]
+
+    def checksum(self, row=None):
+        if row is None:
+            return None
+        return bytes(self._checksums[row * 16:(row + 1) * 16])
+
+    def checksums(self):
+        """ Returns the checksums of all the records, concatenated
+        """
+        return bytes(self._checksums)
+
+    def error(self, row):
+        return self._errors.get(row)
+
+    def isEmpty(self, row):
+        return bool(self._status[row] & self.kEmpty)
+
+    def isImported(self, row):
+        return bool(self._status[row] & self.kImported)
+
+    def isDuplicate(self, row):
+        return bool(self._status[row] & self.kDuplicate)
+
+    def __count(self, row, sign):
+        """ Add (sign=1) or remove (sign=-1) the record from the counters
+        """
+        if not self.isRecordValid(row):
+            self._numBadRecords += sign
+        if self._status[row] & self.kImported:
+            self._numRecordsImported += sign
+        if self.canImportRecord(row):
+            self._numRecordsToImport += sign
+        if self.isDuplicateRecord(row):
+            self._numDuplicateRecords += sign
+
+    def __setStatus(self, row, flag, value):
+        self.__count(row, -1)
+        if value:
+            self._status[row] |= flag
+        else:
+            self._status[row] &= ~flag
+        self.__count(row, 1)
+
+    def setRecordImported(self, row, imported):
+        self.__setStatus(row, self.kImported, imported)
+
+    def setRecordDuplicate(self, row, duplicate):
+        self.__setStatus(row, self.kDuplicate, duplicate)
+
+    def isDuplicateRecord(self, row):
+        """ True if row is valid and repeats an earlier record that hasn't been imported
+        """
+        return self.isRecordValid(row) and self._status[row] & (self.kDuplicate | self.kImported) == self.kDuplicate
+
+    def isRecordValid(self, row):
+        """ True if we have valid raw data and no error
+        """
+        return not self._status[row] & self.kEmpty and row not in self._errors
+
+    def canImportRecord(self, row):
+        return self.isRecordValid(row) and not self._status[row]
+
+    def csvEngine(self):
+        return self._csvEngine
+
+    def setCsvEngine(self, engine):
+        """ Set the name of the engine used to split records into fields
+        """
+        if engine not in csvEngines:
+            raise ImportException('Unknown csv engine %r' % engine)
+        self._csvEngine = engine
+
+    def isFormatted(self):
+        return self._formatted
+
+    def date(self, row):
+        day = self._dates[row]
+        return None if day == self.kNoDate else QtCore.QDate.fromJulianDay(day)
+
+    def description(self, row):
+        # Description is only set if we got as far as decoding the date
+        if self._dates[row] == self.kNoDate:
+            return None
+        return self.fields(row)[self._descriptionIdx]
+
+    def credit(self, row):
+        credit = self._credits[row]
+        return None if math.isnan(credit) else credit
+
+    def debit(self, row):
+        debit = self._debits[row]
+        return None if math.isnan(debit) else debit
+
+    def numRecordsToImport(self):
+        return self._numRecordsToImport
+
+    def numRecordsImported(self):
+        return self._numRecordsImported
+
+    def numBadRecords(self):
+        return self._numBadRecords
+
+    def numDuplicateRecords(self):
+        return self._numDuplicateRecords
+
+    def setRecordsImported(self, checksums):
+        for row in range(self.childCount()):
+            self.setRecordImported(row, self.checksum(row) in checksums)
+
+    def setDuplicateRecords(self, checksums=None):
+        if checksums is None:
+            checksums = set()
+
+        for row in range(self.childCount()):
+            checksum = self.checksum(row)
+            self.setRecordDuplicate(row, checksum in checksums)
+            checksums.add(checksum)
+
+    def reset(self):
+        self._formatted = False
+        self._accountData = None
+        self._pendingBlocks = bytearray()
+        self.__cancelSubmitted()
+
+    def formatItem(self, dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat):
+        self.formatRecords(0, self.childCount(), dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat)
+        self._pendingBlocks = bytearray(len(self._pendingBlocks))
+
+    def setFormat(self, accountData):
+        """ Show the records as formatted with accountData, but only decode
+            them when they're asked for or by formatPending. Errors from any
+            previous format are cleared, so the counters fill in as records
+            are decoded
+        """
+        if accountData is None:
+            self.reset()
+            return
+
+        self._formatted = True
+        self._accountData = tuple(accountData)
+        self._descriptionIdx = self._accountData[1]
+        self._errors = {}
+        self.__recount()
+        self._pendingBlocks = bytearray()
+        self.__cancelSubmitted()
+        self.__setPending(0, self.childCount())
+
+    def __setPending(self, first, last):
+        """ Mark the blocks holding records first to last (exclusive) as needing formatting
+        """
+        numBlocks = -(-len(self._rawData) // self.formatBlockSize)
+        self._pendingBlocks.extend(bytes(numBlocks - len(self._pendingBlocks)))
+        firstBlock = first // self.formatBlockSize
+        lastBlock = -(-last // self.formatBlockSize)
+        self._pendingBlocks[firstBlock:lastBlock] = bytes([self.kBlockPending]) * (lastBlock - firstBlock)
+
+    def __recount(self):
+        """ Recalculate the counters for all records
+        """
+        status = np.frombuffer(bytes(self._status), dtype=np.uint8)
+        valid = (status & self.kEmpty) == 0
+        valid[list(self._errors)] = False
+        self._numBadRecords = int(np.count_nonzero(~valid))
+        self._numRecordsImported = int(np.count_nonzero(status & self.kImported))
+        self._numRecordsToImport = int(np.count_nonzero(valid & (status == 0)))
+        self._numDuplicateRecords = int(np.count_nonzero(
+            valid & ((status & (self.kDuplicate | self.kImported)) == self.kDuplicate)))
+
+    def ensureFormatted(self, row):
+        """ Decode the block of records holding row, if it's still pending
+        """
+        block = row // self.formatBlockSize
+
+        if block < len(self._pendingBlocks) and self._pendingBlocks[block]:
+            self._pendingBlocks[block] = self.kBlockDone
+            first = block * self.formatBlockSize
+            self.formatRecords(first, min(first + self.formatBlockSize, self.childCount()), *self._accountData)
+
+    def isPending(self, row):
+        """ True if row is waiting to be decoded
+        """
+        block = row // self.formatBlockSize
+        return block < len(self._pendingBlocks) and bool(self._pendingBlocks[block])
+
+    def hasPendingRecords(self):
+        return bool(self._pendingBlocks.strip(b'\x00'))
+
+    def formatPending(self, maxRecords=None):
+        """ Decode the first run of pending records, up to maxRecords (rounded
+            up to a whole block). Returns the (first, last) rows decoded, or None
+            if there was nothing to do
+        """
+        # Including any submitted to the format pool - their results will be ignored
+        firstBlock = len(self._pendingBlocks) - len(self._pendingBlocks.lstrip(b'\x00'))
+
+        if firstBlock == len(self._pendingBlocks):
+            return None
+
+        lastBlock = self._pendingBlocks.find(self.kBlockDone, firstBlock)
+        if lastBlock == -1:
+            lastBlock = len(self._pendingBlocks)
+        if maxRecords is not None:
+            lastBlock = min(lastBlock, firstBlock + max(1, maxRecords // self.formatBlockSize))
+
+        self._pendingBlocks[firstBlock:lastBlock] = bytes(lastBlock - firstBlock)
+        first = firstBlock * self.formatBlockSize
+        last = min(lastBlock * self.formatBlockSize, self.childCount())
+        self.formatRecords(first, last, *self._accountData)
+        return first, last
+
+    def submitPending(self, maxRecords, callback):
+        """ Send the first run of pending records that hasn't already been
+            submitted, up to maxRecords, to the format pool to be decoded in the
+            background. callback is called from another thread when they're
+            done, and collectDecoded stores them. Returns False if there
+            was nothing to send, or the pool couldn't take it
+        """
+        firstBlock = self._pendingBlocks.find(self.kBlockPending)
+
+        if firstBlock == -1:
+            return False
+
+        lastBlock = firstBlock + 1
+        maxBlocks = max(1, maxRecords // self.formatBlockSize)
+
+        while (lastBlock < len(self._pendingBlocks) and lastBlock - firstBlock < maxBlocks and
+                self._pendingBlocks[lastBlock] == self.kBlockPending):
+            lastBlock += 1
+
+        self._pendingBlocks[firstBlock:lastBlock] = bytes([self.kBlockSubmitted]) * (lastBlock - firstBlock)
+        first = firstBlock * self.formatBlockSize
+        last = min(lastBlock * self.formatBlockSize, self.childCount())
+
+        try:
+            future = formatPool().submit(
+                decodeRecords, self._rawData[first:last], *self._accountData, engine=self._csvEngine)
+        except (concurrent.futures.process.BrokenProcessPool, RuntimeError):
+            _log.warning('Format pool failed, decoding records in process')
+            discardFormatPool()
+            self._pendingBlocks[firstBlock:lastBlock] = bytes([self.kBlockPending]) * (lastBlock - firstBlock)
+            return False
+
+        self._futures[first] = (last, future)
+        future.add_done_callback(lambda future: callback())
+        return True
+
+    def numSubmitted(self):
+        """ Returns the number of runs of records being decoded by the format pool
+        """
+        return len(self._futures)
+
+    def collectDecoded(self):
+        """ Store the records the format pool has finished decoding, unless
+            they have been decoded since. Returns a list of the (first, last)
+            rows stored
+        """
+        stored = []
+
+        for first, (last, future) in list(self._futures.items()):
+            if not future.done():
+                continue
+
+            del self._futures[first]
+
+            try:
+                dates, credits, debits, errors = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                _log.warning('Format pool failed, decoding records in process')
+                dates, credits, debits, errors = decodeRecords(
+                    self._rawData[first:last], *self._accountData, engine=self._csvEngine)
+
+            for start in range(first, last, self.formatBlockSize):
+                block = start // self.formatBlockSize
+
+                if self._pendingBlocks[block] != self.kBlockSubmitted:
+                    continue
+
+                end = min(start + self.formatBlockSize, last)
+                self._pendingBlocks[block] = self.kBlockDone
+                self.__storeDecoded(
+                    start,
+                    dates[start - first:end - first],
+                    credits[start - first:end - first],
+                    debits[start - first:end - first],
+                    dict((offset - start + first, error) for offset, error in errors.items()
+                        if start <= offset + first < end)
+                )
+
+                if stored and stored[-1][1] == start:
+                    stored[-1] = (stored[-1][0], end)
+                else:
+                    stored.append((start, end))
+
+        return stored
+
+    def __cancelSubmitted(self):
+        for _, future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+    def formatRecords(self, first, last, dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat):
+        """ Decode the records from first up to (but not including) last.
+            Large files are decoded in chunks by the format pool
+        """
+        self._descriptionIdx = descriptionIdx
+        lines = self._rawData[first:last]
+        accountData = (dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat)
+        self._accountData = accountData
+        results = None
+        numWorkers = os.cpu_count() or 1
+
+        if len(lines) >= self.parallelFormatThreshold and numWorkers > 1 and formatPool():
+            chunkSize = -(-len(lines) // numWorkers)
+            chunks = [lines[start:start + chunkSize] for start in range(0, len(lines), chunkSize)]
+            try:
+                results = list(formatPool().map(
+                    decodeRecords, chunks, *[[arg] * len(chunks) for arg in accountData + (self._csvEngine,)]))
+            except concurrent.futures.process.BrokenProcessPool:
+                _log.warning('Format pool failed, decoding records in process')
+
+        if results is None:
+            results = [decodeRecords(lines, *accountData, engine=self._csvEngine)]
+
+        row = first
+        for dates, credits, debits, errors in results:
+            self.__storeDecoded(row, dates, credits, debits, errors)
+            row += len(dates)
+
+        self._formatted = True
+
+    def __storeDecoded(self, first, dates, credits, debits, errors):
+        """ Store the decoded values for the records from first, as returned
+            by decodeRecords, and update the counters
+        """
+        last = first + len(dates)
+
+        for row in range(first, last):
+            self.__count(row, -1)
+            self._errors.pop(row, None)
+
+        self._dates[first:last] = _toArray('l', dates)
+        self._credits[first:last] = _toArray('d', credits)
+        self._debits[first:last] = _toArray('d', debits)
+        self._errors.update((first + offset, error) for offset, error in errors.items())
+
+        for row in range(first, last):
+            self.__count(row, 1)
+
 class CsvRecordItem(TreeItem):
-    def __init__(self, rawData):
+    """ Handle to a record held by a CsvFileItem. If no file item is
+        given then the record is held by a file item of its own
+    """
+    def __init__(self, rawData=None, parent=None, row=0):
         super(CsvRecordItem, self).__init__()
-        self._date = None
-        self._desc = None
-        self._credit = None
-        self._debit = None
-        self._error = None
-        self._formatted = False
-        self._rawData = rawData
-        self._fields = next(csv.reader([self._rawData]))
-        self.reset()
 
-    def reset(self):
-        self._setFormatted(False)
+        if parent is None:
+            parent = CsvFileItem(None)
+            parent.appendRecords([rawData])
+
+        self._parent = parent
+        self._row = row
 
-    def _setFormatted(self, formatted):
-        self._formatted = formatted
-        self.data = self._dataFuncProcessed if formatted else self._dataFuncRaw
+    def reset(self):
+        self._parent.reset()
 
     def checksum(self):
-        return hashlib.md5(self._rawData.encode('utf-8')).hexdigest()
+        return self._parent.checksum(self._row)
 
     def dataDict(self):
+        self._parent.ensureFormatted(self._row)
         return {
-            'date':     self._date,
-            'desc':     self._desc,
-            'credit':     self._credit,
-            'debit':     self._debit,
-            'raw':         self._rawData,
-            'checksum': self.checksum(),
+            'date':     self._parent.date(self._row),
+            'desc':     self._parent.description(self._row),
+            'credit':     self._parent.credit(self._row),
+            'debit':     self._parent.debit(self._row),
+            'raw':         self._parent.rawData(self._row),
+            'checksum': self.checksum().hex(),
         }
 
     def setImported(self, imported):
-        self._imported = imported
+        self._parent.setRecordImported(self._row, imported)
 
     def setDuplicate(self, duplicate):
-        self._duplicate = duplicate
+        self._parent.setRecordDuplicate(self._row, duplicate)
 
     def isSelectable(self):
-        return self._formatted and self.canImport()
+        return self._parent.isFormatted() and self.canImport()
 
     def canImport(self):
-        return self.isValid() and not self._imported and not self._duplicate
+        self._parent.ensureFormatted(self._row)
+        return self._parent.canImportRecord(self._row)
+
+    def numRecordsImported(self):
+        return int(self._parent.isImported(self._row))
+
+    def numDuplicateRecords(self):
+        return int(self._parent.isDuplicateRecord(self._row))
 
     @property
     def _statusAsText(self):
         """ Property to get the status description
         """
-        if self._rawData is None:
+        error = self._parent.error(self._row)
+
+        if self._parent.isEmpty(self._row):
             return 'Invalid'
-        elif self._error is not None:
-            return self._error
-        elif self._imported:
+        elif error is not None:
+            return error
+        elif self._parent.isImported(self._row):
             return 'Imported'
-        elif self._duplicate:
+        elif self._parent.isDuplicate(self._row):
             return 'Duplicate'
 
         return 'Ready'
@@ -208,31 +1050,39 @@ class CsvRecordItem(TreeItem):
     def isValid(self):
         """ True if we have valid raw data and no error
         """
-        return self._rawData and not self._error
+        self._parent.ensureFormatted(self._row)
+        return self._parent.isRecordValid(self._row)
 
     def columnCount(self):
-        if not self._formatted:
-            return len(self._fields)
-        elif self._error:
+        self._parent.ensureFormatted(self._row)
+        if not self._parent.isFormatted():
+            return len(self._parent.fields(self._row))
+        elif self._parent.error(self._row):
             return 1
         return 6
 
-    def _dataFuncRaw(self, column, role):
+    def data(self, column, role):
+        if not self._parent.isFormatted():
+            return self._dataRaw(column, role)
+        self._parent.ensureFormatted(self._row)
+        return self._dataProcessed(column, role)
+
+    def _dataRaw(self, column, role):
         if role == QtCore.Qt.DisplayRole:
             try:
-                return self._fields[column]
+                return self._parent.fields(self._row)[column]
             except IndexError:
                 pass
 
-    def _dataFuncProcessed(self, column, role):
+    def _dataProcessed(self, column, role):
 
         if role == QtCore.Qt.ForegroundRole:
             if column == enum.kImport_Status:
                 if not self.isValid():
                     return QtGui.QColor(255, 0, 0)
-                elif self._imported:
+                elif self._parent.isImported(self._row):
                     return QtGui.QColor(255, 165, 0)
-                elif self._duplicate:
+                elif self._parent.isDuplicate(self._row):
                     return QtGui.QColor(255, 165, 0)
                 return QtGui.QColor(0, 255, 0)
 
@@ -240,126 +1090,226 @@ class CsvRecordItem(TreeItem):
             if column == enum.kImport_Status:
                 return self._statusAsText
             elif column == enum.kImport_Date:
-                return self._date
+                return self._parent.date(self._row)
             elif column == enum.kImport_Credit:
-                return '%.02f' % self._credit if self._credit else None
+                credit = self._parent.credit(self._row)
+                return '%.02f' % credit if credit else None
             elif column == enum.kImport_Debit:
-                return '%.02f' % abs(self._debit) if self._debit else None
+                debit = self._parent.debit(self._row)
+                return '%.02f' % abs(debit) if debit else None
             elif column == enum.kImport_Description:
-                return self._desc
+                return self._parent.description(self._row)
 
         elif role == QtCore.Qt.ToolTipRole:
-            return self._rawData
+            return self._parent.rawData(self._row)
 
     def formatItem(self, dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat):
+        self._parent.formatRecords(
+            self._row, self._row + 1, dateIdx, descriptionIdx, creditIdx, debitIdx, currencySign, dateFormat)
+
+def readCsvFiles(files, batchSize=1000):
+    """ Generator to read the csv files in batches of records. Yields the row
+        of the file, the end offsets of the lines, their checksums and the
+        percentage read of all files. The files are memory mapped, so the
+        lines are only decoded here to calculate the checksums
+    """
+    totalBytes = sum(os.path.getsize(filename) for filename in files) or 1
+    bytesRead = 0
 
-        self._date = None
-        self._desc = None
-        self._credit = None
-        self._debit = None
-        self._error = None
+    for fileRow, filename in enumerate(files):
+        lines = MappedLines(filename)
 
-        if not self.isValid():
-            return
+        for ends in lines.scan(batchSize):
+            first = len(lines)
+            lines.extend(ends)
+            checksums = [recordChecksum(line) for line in lines[first:]]
+            yield fileRow, ends, checksums, 100 * (bytesRead + int(ends[-1])) // totalBytes
 
-        try:
-            if max(dateIdx, descriptionIdx, creditIdx, debitIdx) > len(self._fields) -1:
-                raise DecoderError('Bad Record')
-
-            self._date = self.__getDateField(self._fields[dateIdx], dateFormat)
-            self._desc = self._fields[descriptionIdx]
-
-            if debitIdx == creditIdx:
-                amount = self._getAmountField(self._fields[debitIdx])
-                if amount is not None:
-                    # Use currency multiplier to ensure that credit is +ve (money in),
-                    # debit -ve (money out)
-                    amount *= currencySign
-
-                    if amount > 0.0:
-                        self._credit = amount
-                    else:
-                        self._debit = amount
-            else:
-                debitField = self._getAmountField(self._fields[debitIdx])
-                creditField = self._getAmountField(self._fields[creditIdx])
-                self._debit = abs(debitField) * -1.0 if debitField else None
-                self._credit = abs(creditField) if creditField else None
+        bytesRead += lines.size()
 
-            if not self._debit and not self._credit:
-                raise DecoderError('No credit or debit found')
+class CsvReader(QtCore.QThread):
+    """ Worker thread to read the csv files, passing the records
+        back to the model in batches
+    """
+    recordsRead = QtCore.pyqtSignal(int, object, list)
+    progress = QtCore.pyqtSignal(int)
 
-        except DecoderError as exc:
-            self._error = str(exc)
+    def __init__(self, files, parent=None):
+        super(CsvReader, self).__init__(parent=parent)
+        self._files = files
 
-        finally:
-            self._setFormatted(True)
+    def run(self):
+        for fileRow, ends, checksums, percent in readCsvFiles(self._files):
+            if self.isInterruptionRequested():
+                return
 
-    def _getAmountField(self, field):
-        """ Extract and return amount from str type to double.
-            If a simple conversion doesn't succeed, then try and parse
-            the string to remove any currency sign or other junk.
+            self.recordsRead.emit(fileRow, ends, checksums)
+            self.progress.emit(percent)
 
-            Returns None if field does not contain valid double.
-        """
+class ImportModel(QtCore.QAbstractItemModel):
+    # pyqtSignal emitted with the percentage of the files read
+    loadProgress = QtCore.pyqtSignal(int)
+    # pyqtSignal emitted when all files have been read, or loading cancelled
+    loadFinished = QtCore.pyqtSignal()
+    # pyqtSignal emitted when all records have been decoded for the account
+    formatFinished = QtCore.pyqtSignal()
+    # pyqtSignal emitted from the format pool's thread when it has decoded some records
+    __recordsDecoded = QtCore.pyqtSignal()
+
+    # Number of records to decode each time the event loop is idle, or
+    # to send to each of the format pool's workers
+    idleFormatRecords = 4096
 
-        # Sanitise field
-        field = re.sub('[^\d.-]', '', field)
+    def __init__(self, files, parent=None):
+        super(ImportModel, self).__init__(parent=parent)
+        self._files = files
+        self._headers = []
+        self._root = TreeItem()
+        self._checksums = set()
+        self._checksumsSaved = set()
+        self.__seenChecksums = ChecksumSet()
+        self.__accountData = None
+        self.__currentTimestamp = None
+        self.__reader = None
 
-        try:
-            return float(field)
-        except ValueError:
-            pass
+        # Records not yet shown are decoded whenever the event loop is idle
+        self.__formatTimer = QtCore.QTimer(self)
+        self.__formatTimer.setInterval(0)
+        self.__formatTimer.timeout.connect(self.__formatIdle)
+        self.__formatting = False
 
+        # With more than one cpu, the format pool decodes them in the background
+        self.__recordsDecoded.connect(self.__formatIdle, QtCore.Qt.QueuedConnection)
 
-    def __getDateField(self, field, dateFormat):
-        """ Extract date field using supplied format
-        """
-        date = QtCore.QDate.fromString(field, dateFormat)
+        # Records are added by load or loadInBackground
+        for filename in files:
+            self._root.appendChild(CsvFileItem(filename))
 
-        if not date.isValid():
-            raise DecoderError('Invalid date: %r' % field)
+        self._numColumns = self._root.maxColumns()
+        self._headers = list(range(self._numColumns))
 
-        return date
+        engine = QtCore.QSettings().value('options/csvengine', defaultCsvEngine)
+        if engine not in csvEngines:
+            _log.warning('Unknown csv engine %r, using %r', engine, defaultCsvEngine)
+            engine = defaultCsvEngine
+        self.setCsvEngine(engine)
 
-class ImportModel(QtCore.QAbstractItemModel):
+    def csvEngine(self):
+        return self.__csvEngine
 
-    def __init__(self, files, parent=None):
-        super(ImportModel, self).__init__(parent=parent)
-        self._headers = []
-        self._root = TreeItem()
-        self._checksums = []
-        self._checksumsSaved = None
-        self.__currentTimestamp = None
+    def setCsvEngine(self, engine):
+        """ Set the name of the engine (from csvEngines) used to split the
+            records into fields. Any records already decoded are decoded again
+            ImportException if the engine isn't known
+        """
+        if engine not in csvEngines:
+            raise ImportException('Unknown csv engine %r' % engine)
 
-        # Import all record checksums
-        query = QtSql.QSqlQuery("""
-            SELECT checksum
-              FROM records r
-        INNER JOIN accounts a
-                ON a.id=r.accountid
-               AND a.userid=%d
-            """ % db.userId)
+        for fileItem in self._root.children():
+            fileItem.setCsvEngine(engine)
 
-        if query.lastError().isValid():
-            raise Exception(query.lastError().text())
+        self.__csvEngine = engine
 
-        while query.next():
-            self._checksums.append(query.value(0))
+        if self.__accountData is not None:
+            self.accountChanged(self.__accountData)
 
-        self._checksumsSaved = self._checksums[:]
+    def load(self):
+        """ Read all the files
+        """
+        for fileRow, ends, checksums, percent in readCsvFiles(self._files):
+            self.__addRecords(fileRow, ends, checksums)
+            self.loadProgress.emit(percent)
 
-        for item in self.readFiles(files):
-            self._root.appendChild(item)
+        self.loadFinished.emit()
 
-        self._root.setRecordsImported(self._checksums)
-        self._root.setDuplicateRecords()
+    def loadInBackground(self):
+        """ Read the files in a worker thread. Records are added to the
+            model as they are read
+        """
+        self.__reader = CsvReader(self._files, self)
+        self.__reader.recordsRead.connect(self.__addRecords)
+        self.__reader.progress.connect(self.loadProgress)
+        self.__reader.finished.connect(self.loadFinished)
+        self.__reader.start()
 
-        self._numColumns = self._root.maxColumns()
-        self._headers = list(range(self._numColumns))
+    def isLoading(self):
+        return self.__reader is not None and self.__reader.isRunning()
+
+    def cancelLoad(self):
+        """ Stop reading the files - any records already read are kept
+        """
+        if self.isLoading():
+            self.__reader.recordsRead.disconnect(self.__addRecords)
+            self.__reader.requestInterruption()
+            self.__reader.wait()
+
+    def __addRecords(self, fileRow, ends, checksums):
+        """ Add a batch of records, given by the end offsets of their lines,
+            to a file item and set their imported and duplicate status
+        """
+        fileItem = self._root.child(fileRow)
+        first = fileItem.childCount()
+        imported = self.importedChecksums(checksums)
+        self._checksums |= imported
+        self._checksumsSaved |= imported
+
+        flags = [
+            (fileItem.kImported if checksum in self._checksums else 0) | (fileItem.kDuplicate if duplicate else 0)
+            for checksum, duplicate in zip(checksums, self.__seenChecksums.add(checksums).tolist())
+        ]
+
+        self.beginInsertRows(self.index(fileRow, 0), first, first + len(ends) - 1)
+        fileItem.appendLines(ends, checksums, flags)
+        self.endInsertRows()
+
+        if fileItem.hasPendingRecords():
+            self.__startFormatting()
+
+        numColumns = self._root.maxColumns()
+
+        if numColumns > self._numColumns:
+            self.beginInsertColumns(QtCore.QModelIndex(), self._numColumns, numColumns - 1)
+            self._numColumns = numColumns
+            if self.__accountData is None:
+                self._headers = list(range(numColumns))
+            self.endInsertColumns()
+
+    # Number of checksums to look up with each query
+    checksumChunkSize = 10000
+
+    def importedChecksums(self, checksums):
+        """ Returns the set of checksums that have already been imported
+            by the current user. Only the checksums we're interested in are
+            sent to the server, rather than reading every record's checksum
+        """
+        checksums = [checksum.hex() for checksum in set(checksums)]
+        imported = set()
+
+        for start in range(0, len(checksums), self.checksumChunkSize):
+            query = QtSql.QSqlQuery()
+            query.setForwardOnly(True)
+            query.prepare("""
+                SELECT r.checksum
+                  FROM records r
+            INNER JOIN accounts a
+                    ON a.id=r.accountid
+                   AND a.userid=?
+                 WHERE r.checksum = ANY(string_to_array(?, ','))
+                """)
+            query.addBindValue(db.userId)
+            # Hex digests never contain a comma
+            query.addBindValue(','.join(checksums[start:start + self.checksumChunkSize]))
+
+            if not query.exec_():
+                raise Exception(query.lastError().text())
+
+            while query.next():
+                imported.add(bytes.fromhex(query.value(0)))
+
+        return imported
 
     def reset(self):
-        self._checksums = self._checksumsSaved[:]
+        self._checksums = self._checksumsSaved.copy()
         self.beginResetModel()
         self._root.setRecordsImported(self._checksums)
         self.endResetModel()
@@ -374,76 +1324,295 @@ class ImportModel(QtCore.QAbstractItemModel):
     def numRecordsImported(self):
         return self._root.numRecordsImported()
 
+    def numDuplicateRecords(self):
+        return self._root.numDuplicateRecords()
+
     def accountChanged(self, accountData):
         """ Account selection has changed
 
             Get settings for the account and create new model to decode the data
         """
-        self.beginResetModel()
-        with utils.showWaitCursor():
-            if accountData is None:
-                self._root.reset()
-                self._headers = list(range(self._root.maxColumns()))
-            else:
-                dateField, descriptionField, creditField, debitField, currencySign, dateFormat = accountData
-                self._root.formatItem(dateField, descriptionField, creditField, debitField, currencySign, dateFormat)
-                self._headers = ['Status', 'Date', 'Credit', 'Debit', 'Description']
+        self.__accountData = accountData
+        self._root.setFormat(accountData)
+
+        if accountData is None:
+            self.__formatTimer.stop()
+            self.__formatting = False
+            self._headers = list(range(self._root.maxColumns()))
+        else:
+            self.__startFormatting()
+            self._headers = ['Status', 'Date', 'Credit', 'Debit', 'Description']
+
+        # Replace the columns, rather than resetting the model or changing the
+        # header data and every record, as either makes views lay out all the
+        # records again. The new columns go in front and the old ones, which
+        # no longer show anything, are then removed
+        numColumns = self._root.maxColumns()
+        oldColumns = self._numColumns
+
+        self.beginInsertColumns(QtCore.QModelIndex(), 0, numColumns - 1)
+        self._numColumns = numColumns + oldColumns
+        self.endInsertColumns()
+
+        self.beginRemoveColumns(QtCore.QModelIndex(), numColumns, numColumns + oldColumns - 1)
+        self._numColumns = numColumns
+        self.endRemoveColumns()
+
+    def isFormatting(self):
+        """ True if there are records still to be decoded for the account
+        """
+        return self.__formatting
 
-        self._numColumns = self._root.maxColumns()
+    def formatPending(self):
+        """ Decode all remaining records now
+        """
+        for fileItem in self._root.children():
+            while fileItem.formatPending() is not None:
+                pass
 
-        self.endResetModel()
+        self.__formatIdle()
+
+    def __startFormatting(self):
+        self.__formatting = True
+        self.__formatTimer.start()
+
+    def __useFormatPool(self):
+        return (os.cpu_count() or 1) > 1 and formatPool() is not None
+
+    def __formatIdle(self):
+        """ Decode the next idleFormatRecords records, or keep each of the
+            format pool's workers busy decoding them in the background
+        """
+        if not self.__formatting:
+            return
+
+        if self.__useFormatPool() and self.__formatInPool():
+            return
+
+        # Decode in process if the pool isn't available
+        self.__formatTimer.start()
+
+        for fileRow, fileItem in enumerate(self._root.children()):
+            rows = fileItem.formatPending(self.idleFormatRecords)
+
+            if rows is not None:
+                self.__emitDecoded(fileRow, *rows)
+                return
+
+        self.__finishFormatting()
+
+    def __formatInPool(self):
+        """ Store the records decoded by the format pool and submit more. The
+            pool signals when it has finished some, so the timer isn't needed.
+            Returns False if there's nothing left in the pool
+        """
+        self.__formatTimer.stop()
+        numSubmitted = 0
+
+        for fileRow, fileItem in enumerate(self._root.children()):
+            for first, last in fileItem.collectDecoded():
+                self.__emitDecoded(fileRow, first, last)
+            numSubmitted += fileItem.numSubmitted()
+
+        for fileItem in self._root.children():
+            while numSubmitted < os.cpu_count() and fileItem.submitPending(
+                    self.idleFormatRecords, self.__notifyDecoded):
+                numSubmitted += 1
+
+        return numSubmitted > 0
+
+    def __notifyDecoded(self):
+        """ Called by the format pool's thread when a run of records is decoded
+        """
+        try:
+            self.__recordsDecoded.emit()
+        except RuntimeError:
+            # The model has been deleted
+            pass
+
+    def __emitDecoded(self, fileRow, first, last):
+        parent = self.index(fileRow, 0)
+        self.dataChanged.emit(
+            self.index(first, 0, parent),
+            self.index(last - 1, self._numColumns - 1, parent)
+        )
+
+    def __finishFormatting(self):
+        self.__formatTimer.stop()
+
+        if self.__formatting:
+            self.__formatting = False
+            self.formatFinished.emit()
+
+    def recordsToImport(self):
+        """ Returns the indexes of all records that can be imported
+        """
+        self.formatPending()
+        indexes = []
+        for fileRow in range(self._root.childCount()):
+            fileItem = self._root.child(fileRow)
+            fileIndex = self.index(fileRow, 0)
+            indexes.extend(
+                self.index(row, 0, fileIndex)
+                    for row in range(fileItem.childCount()) if fileItem.canImportRecord(row)
+            )
+        return indexes
+
+    def numRecords(self):
+        return sum(fileItem.childCount() for fileItem in self._root.children())
+
+    # Number of records to insert with each statement
+    saveChunkSize = 1000
 
     def saveRecord(self, accountId, currencyCode, index):
         """ Saves the import record to the database
             ImportException on error
         """
-        item = self.getNodeItem(index)
-        rec = item.dataDict()
+        for _ in self.saveRecords(accountId, currencyCode, [index]):
+            pass
 
+    def saveRecords(self, accountId, currencyCode, indexes):
+        """ Saves the import records to the database, inserting saveChunkSize
+            records per statement. This is a generator that yields the number
+            of records saved after each chunk, so the caller can show progress
+            ImportException on error
+        """
         # Ensure we record the same timestamp for this import
         self.__currentTimestamp = self.__currentTimestamp or QtCore.QDateTime.currentDateTime()
 
-        query = QtSql.QSqlQuery()
-        query.prepare("""
-            INSERT INTO records (date, accountid,
-                                 description, amount, insertdate,
-                                 rawdata, checksum, currency)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """)
+        for start in range(0, len(indexes), self.saveChunkSize):
+            chunk = indexes[start:start + self.saveChunkSize]
+            items = [self.getNodeItem(index) for index in chunk]
+            records = [item.dataDict() for item in items]
+
+            query = QtSql.QSqlQuery()
+            query.prepare("""
+                INSERT INTO records (date, accountid,
+                                     description, amount, insertdate,
+                                     rawdata, checksum, currency)
+                             VALUES %s
+            """ % ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?)'] * len(records)))
+
+            for rec in records:
+                query.addBindValue(rec['date'])
+                query.addBindValue(accountId)
+                query.addBindValue(rec['desc'])
+                query.addBindValue(rec['credit'] or rec['debit'])
+                query.addBindValue(self.__currentTimestamp)
+                query.addBindValue(rec['raw'])
+                query.addBindValue(rec['checksum'])
+                query.addBindValue(currencyCode)
+
+            query.exec_()
+
+            if query.lastError().isValid():
+                raise ImportException(query.lastError().text())
+
+            for item, rec in zip(items, records):
+                self._checksums.add(item.checksum())
+                item.setImported(True)
+
+            self.__emitDataChanged(chunk)
+            yield start + len(chunk)
+
+    # Settings group used to record the progress of a chunked import
+    progressGroup = 'import'
+
+    def batchKey(self, accountId):
+        """ Returns a digest of the account and the records in the files,
+            to recognise an import of the same files again
+        """
+        digest = hashlib.md5(str(accountId).encode('utf-8'))
+        for fileItem in self._root.children():
+            digest.update(fileItem.checksums())
+        return digest.hexdigest()
+
+    def resumableBatch(self, accountId):
+        """ Returns the timestamp of an interrupted chunked import of the same
+            files to accountId, or None. Records already committed are shown as
+            imported, so importing the remainder with this timestamp completes the batch
+        """
+        settings = QtCore.QSettings()
+        settings.beginGroup(self.progressGroup)
 
-        query.addBindValue(rec['date'])
-        query.addBindValue(accountId)
-        query.addBindValue(rec['desc'])
-        query.addBindValue(rec['credit'] or rec['debit'])
-        query.addBindValue(self.__currentTimestamp)
-        query.addBindValue(rec['raw'])
-        query.addBindValue(rec['checksum'])
-        query.addBindValue(currencyCode)
+        if settings.value('key') != self.batchKey(accountId):
+            return None
 
-        query.exec_()
+        batch = settings.value('batch')
+        return batch if isinstance(batch, QtCore.QDateTime) and batch.isValid() else None
+
+    def importRecords(self, accountId, currencyCode, indexes, chunkSize):
+        """ Saves the import records, committing every chunkSize records in a
+            separate transaction so an interrupted import keeps the chunks
+            already committed. The batch is recorded in the settings so that if
+            the import fails, a later import of the same files to the account
+            resumes the same batch (insertdate). The committed records are found
+            by their checksums, so only the rest are imported. Closing the
+            generator cancels the import, and it won't be resumed.
+            Yields the number of records committed after each chunk
+            ImportException on error
+        """
+        self.__currentTimestamp = (self.__currentTimestamp or
+            self.resumableBatch(accountId) or QtCore.QDateTime.currentDateTime())
 
-        if query.lastError().isValid():
-            raise ImportException(query.lastError().text())
+        settings = QtCore.QSettings()
+        settings.beginGroup(self.progressGroup)
+        settings.setValue('key', self.batchKey(accountId))
+        settings.setValue('batch', self.__currentTimestamp)
+        settings.sync()
 
-        self._checksums.append(rec['checksum'])
-        item.setImported(True)
-        self.dataChanged.emit(index, index)
+        try:
+            for start in range(0, len(indexes), chunkSize):
+                chunk = indexes[start:start + chunkSize]
+
+                try:
+                    with db.transaction():
+                        for _ in self.saveRecords(accountId, currencyCode, chunk):
+                            pass
+
+                except Exception:
+                    # The chunk has been rolled back
+                    for index in chunk:
+                        item = self.getNodeItem(index)
+                        self._checksums.discard(item.checksum())
+                        item.setImported(False)
+                    self.__emitDataChanged(chunk)
+                    raise
+
+                self._checksumsSaved |= set(self.getNodeItem(index).checksum() for index in chunk)
+                yield start + len(chunk)
+
+        except GeneratorExit:
+            # Cancelled - nothing to resume
+            settings.remove('')
+            raise
+
+        # Finished - nothing to resume
+        settings.remove('')
+
+    def __emitDataChanged(self, indexes):
+        """ Emit one dataChanged signal for each parent in indexes
+        """
+        rows = {}
+        for index in indexes:
+            rows.setdefault(QtCore.QPersistentModelIndex(index.parent()), []).append(index.row())
+
+        for parent, parentRows in rows.items():
+            parent = QtCore.QModelIndex(parent)
+            self.dataChanged.emit(
+                self.index(min(parentRows), 0, parent),
+                self.index(max(parentRows), self.columnCount() - 1, parent)
+            )
 
     def getNodeItem(self, index):
+        """ The internal pointer of an index is the parent item, so only the
+            file items need to exist - records are created on demand
+        """
         if index.isValid():
-            return index.internalPointer()
+            return index.internalPointer().child(index.row())
 
         return self._root
 
-    def readFiles(self, files):
-        for filename in files:
-            item = CsvFileItem(filename)
-            with codecs.open(filename, 'rb', 'ISO-8859-1') as f:
-                for line in f:
-                    recItem = CsvRecordItem(line.strip())
-                    item.appendChild(recItem)
-            yield item
-
     def columnCount(self, parent=QtCore.QModelIndex()):
         return self._numColumns
 
@@ -460,10 +1629,20 @@ class ImportModel(QtCore.QAbstractItemModel):
         if not index.isValid():
             return 0
 
-        if self.getNodeItem(index).isSelectable():
-            return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        parentItem = index.internalPointer()
 
-        return QtCore.Qt.ItemIsEnabled
+        if parentItem is self._root:
+            return QtCore.Qt.ItemIsEnabled
+
+        # Views ask for the flags of every row they lay out, so records still
+        # waiting to be decoded are left unselectable rather than decoded here
+        row = index.row()
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemNeverHasChildren
+
+        if parentItem.isFormatted() and not parentItem.isPending(row) and parentItem.canImportRecord(row):
+            flags |= QtCore.Qt.ItemIsSelectable
+
+        return flags
 
     def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
         if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
@@ -476,29 +1655,28 @@ class ImportModel(QtCore.QAbstractItemModel):
 
     def index(self, row, column, parent=QtCore.QModelIndex()):
 
-        if not self.hasIndex(row, column, parent):
+        # Views call this for every record, so check the bounds here rather than with hasIndex
+        if row < 0 or column < 0 or column >= self._numColumns or parent.column() > 0:
             return QtCore.QModelIndex()
 
         parentItem = self.getNodeItem(parent)
-        childItem = parentItem.child(row)
 
-        if childItem:
-            return self.createIndex( row, column, childItem)
+        if row >= parentItem.childCount():
+            return QtCore.QModelIndex()
 
-        return QtCore.QModelIndex()
+        return self.createIndex(row, column, parentItem)
 
     def parent(self, index):
 
         if not index.isValid():
             return QtCore.QModelIndex()
 
-        childItem = self.getNodeItem(index)
-        parentItem = childItem.parent()
+        parentItem = index.internalPointer()
 
-        if parentItem == self._root:
+        if parentItem is self._root:
             return QtCore.QModelIndex()
 
-        return self.createIndex(parentItem.row(), 0, parentItem)
+        return self.createIndex(parentItem.row(), 0, parentItem.parent())
 
     def rowCount(self, parent=QtCore.QModelIndex()):
 
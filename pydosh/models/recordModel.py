@@ -1,27 +1,175 @@
 import re
 import logging
+import operator
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtSql
 
 from pydosh import enum, currency, utils
 from pydosh.database import db
+from .recordStore import RecordStore
 
 _log = logging.getLogger('pydosh.recordModel')
 
-class RecordModel(QtSql.QSqlTableModel):
-    """ QSqlTableModel to represent the records table
+class RecordModel(QtCore.QAbstractTableModel):
+    """ Table model to represent the records table. Rows are read into memory
+        by select(); either all at once or, when paging is enabled, in keyset
+        windows as the view scrolls
     """
+    # pyqtSignal emitted with the error text when records can't be read
+    readError = QtCore.pyqtSignal(str)
+
+    # Number of rows to read per window when paging
+    pageSize = 500
+
+    # Columns that can be ordered on the server when paging, and whether an
+    # ascending sort in the view means descending values (see RecordProxyModel.lessThan)
+    __sortExpressions = {
+        enum.kRecords_Checked: ('r.checked', True),
+        enum.kRecords_Date: ('r.date', True),
+        enum.kRecords_AccountTypeName: ('a.name', False),
+        enum.kRecords_Description: ('r.description', False),
+        enum.kRecords_Amount: ('r.amount', True),
+    }
+
     def __init__(self, parent=None):
         super(RecordModel, self).__init__(parent=parent)
         self._highlightText = None
+        self._rows = []
+        self._store = RecordStore()
+        self._paging = False
+        self._moreRows = False
+        self._filterClause = ''
+        self._filterValues = []
+        self._sortColumn = enum.kRecords_Date
+        self._sortOrder = QtCore.Qt.AscendingOrder
+        self._lastError = QtSql.QSqlError()
+
+    def setPaging(self, paging):
+        """ When paging is enabled only the rows matching the record filter
+            are read, one window at a time
+        """
+        self._paging = paging
+
+    def isPaging(self):
+        return self._paging
+
+    def setRecordFilter(self, clause, values):
+        """ Set the SQL condition used to select records when paging,
+            with the values to bind to its placeholders
+        """
+        self._filterClause = clause
+        self._filterValues = values[:]
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """ Records are sorted by the proxy model unless paging, when
+            the ordering has to be done on the server
+        """
+        self._sortColumn = column
+        self._sortOrder = order
+
+        if self._paging:
+            self.select()
+
+    def lastError(self):
+        return self._lastError
 
     def select(self):
-        """ Buffer the select statement for large datasets
+        """ Read the records from the database. Without paging all rows are
+            read, otherwise the first window only and the rest is read by fetchMore
+        """
+        self.beginResetModel()
+        self._rows = []
+        self._store = RecordStore()
+        self._moreRows = False
+        try:
+            rows = self.__readRows()
+            if rows is not None:
+                self._rows = rows
+                self._store = RecordStore(rows)
+        finally:
+            self.endResetModel()
+
+        return rows is not None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self._paging and self._moreRows
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        """ Read the next window of records, starting after the last row we have
         """
-        status = super(RecordModel, self).select()
-        while self.canFetchMore():
-            self.fetchMore()
+        if not self.canFetchMore(parent):
+            return
+
+        rows = self.__readRows(self._rows[-1] if self._rows else None)
 
-        return status
+        if rows:
+            self.beginInsertRows(QtCore.QModelIndex(), len(self._rows), len(self._rows) + len(rows) - 1)
+            self._rows.extend(rows)
+            self._store.append(rows)
+            self.endInsertRows()
+
+    def store(self):
+        """ Columnar copy of the rows, used by the proxy model for filtering and sorting
+        """
+        return self._store
+
+    def __sortKey(self):
+        """ Returns the column, SQL expression and direction (True if descending)
+            to order by. Columns that can't be ordered on the server use the date
+        """
+        column = self._sortColumn if self._sortColumn in self.__sortExpressions else enum.kRecords_Date
+        expression, descending = self.__sortExpressions[column]
+
+        if self._sortOrder == QtCore.Qt.DescendingOrder:
+            descending = not descending
+
+        return column, expression, descending
+
+    def __readRows(self, lastRow=None):
+        """ Run the select statement and return the rows as a list of values,
+            or None on error. When paging, only the window after lastRow is read
+        """
+        conditions = ''
+        values = [db.userId]
+        orderBy = 'r.date, r.recordid'
+        limit = ''
+
+        if self._paging:
+            column, expression, descending = self.__sortKey()
+            direction = 'DESC' if descending else 'ASC'
+            orderBy = '%s %s, r.recordid %s' % (expression, direction, direction)
+            limit = 'LIMIT %d' % self.pageSize
+
+            if self._filterClause:
+                conditions += ' AND %s' % self._filterClause
+                values.extend(self._filterValues)
+
+            if lastRow is not None:
+                # Keyset pagination - carry on from the last row read
+                conditions += ' AND (%s, r.recordid) %s (?, ?)' % (expression, '<' if descending else '>')
+                values.extend([lastRow[column], lastRow[enum.kRecords_RecordId]])
+
+        query = QtSql.QSqlQuery()
+        query.setForwardOnly(True)
+        query.prepare(self.selectStatement(conditions, orderBy, limit))
+
+        for value in values:
+            query.addBindValue(value)
+
+        if not query.exec_():
+            self._lastError = query.lastError()
+            _log.error('Failed to read records: %s', self._lastError.text())
+            self.readError.emit(self._lastError.text())
+            return None
+
+        rows = []
+        numColumns = query.record().count()
+
+        while query.next():
+            rows.append([query.value(column) for column in range(numColumns)])
+
+        self._moreRows = self._paging and len(rows) == self.pageSize
+        return rows
 
     def isWritable(self, index):
         """ True if the row from the index is owned
@@ -32,25 +180,42 @@ class RecordModel(QtSql.QSqlTableModel):
     def flags(self, index):
         """ Set the flags to allow checkable items
         """
-        flags = super(RecordModel, self).flags(index)
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+
+        flags = QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
         if index.column() == enum.kRecords_Checked and self.isWritable(index):
             return flags | QtCore.Qt.ItemIsUserCheckable
         return flags
 
-    def selectStatement(self):
-        """ Returns the select statement for the record table
-        """
-        if not self.tableName():
-            return None
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return enum.kRecords_Currency + 1
 
+    def selectStatement(self, conditions='', orderBy='r.date, r.recordid', limit=''):
+        """ Returns the select statement for the record table. The
+            first placeholder is the user id
+        """
         query = """
         SELECT r.recordid,
                r.checked,
-               array_to_string(array_agg(t.tagname ORDER BY t.tagname), '##'),
+               COALESCE((
+                   SELECT array_to_string(array_agg(t.tagname ORDER BY t.tagname), '##')
+                     FROM recordtags rt
+               INNER JOIN tags t
+                       ON t.tagid=rt.tagid
+                    WHERE rt.recordid=r.recordid
+               ), ''),
                r.checkdate,
                r.date,
                r.accountid,
-               a2.userid,
+               a.userid,
                a.name,
                r.description,
                r.amount,
@@ -58,30 +223,53 @@ class RecordModel(QtSql.QSqlTableModel):
                r.rawdata,
                r.currency
           FROM records r
-     LEFT JOIN accounts a
+    INNER JOIN accounts a
             ON a.id=r.accountid
-     LEFT JOIN recordtags rt
-            ON rt.recordid=r.recordid
-     LEFT JOIN tags t
-            ON rt.tagid=t.tagid
-    INNER JOIN records r2
-            ON r2.recordid=r.recordid
-    INNER JOIN accounts a2
-            ON a2.id=r2.accountid
-         WHERE a.userid = %(userid)s
-      GROUP BY r.recordid, a.name, a2.userid
-      ORDER BY r.date, r.recordid
-    """ % {'userid': db.userId}
+         WHERE a.userid=?
+               %(conditions)s
+      ORDER BY %(orderBy)s
+               %(limit)s
+    """ % {'conditions': conditions, 'orderBy': orderBy, 'limit': limit}
 
         return query
 
+    def filterTotals(self):
+        """ Returns the total number of records, the number matching the
+            record filter and the in and out totals of those that match
+        """
+        query = QtSql.QSqlQuery()
+        query.prepare("""
+            SELECT COUNT(*),
+                   COALESCE(SUM(matched), 0),
+                   COALESCE(SUM(CASE WHEN matched=1 AND amount > 0 THEN amount END), 0),
+                   COALESCE(ABS(SUM(CASE WHEN matched=1 AND amount < 0 THEN amount END)), 0)
+              FROM (
+                    SELECT r.amount,
+                           CASE WHEN %s THEN 1 ELSE 0 END AS matched
+                      FROM records r
+                INNER JOIN accounts a
+                        ON a.id=r.accountid
+                     WHERE a.userid=?
+                   ) s
+        """ % (self._filterClause or 'TRUE'))
+
+        for value in self._filterValues + [db.userId]:
+            query.addBindValue(value)
+
+        if not query.exec_():
+            raise Exception(query.lastError().text())
+
+        query.next()
+        return query.value(0), query.value(1), query.value(2), query.value(3)
+
     def deleteRecords(self, indexes):
         """ Delete rows manually - bulk deletion way quicker than using the model
         """
-        recordIds = (
-            self.index(index.row(), enum.kRecords_RecordId).data()
-                for index in indexes if self.isWritable(index)
-        )
+        rows = sorted(set(index.row() for index in indexes if self.isWritable(index)))
+        recordIds = [self._value(row, enum.kRecords_RecordId) for row in rows]
+
+        if not recordIds:
+            return True
 
         query = QtSql.QSqlQuery("""
             DELETE FROM records
@@ -89,11 +277,74 @@ class RecordModel(QtSql.QSqlTableModel):
         """ % ','.join(str(rec) for rec in recordIds))
 
         if query.lastError().isValid():
+            self._lastError = query.lastError()
+            return False
+
+        self.__removeRows(rows)
+        return True
+
+    def __removeRows(self, rows):
+        """ Remove rows from the buffer, one block of consecutive rows at a time
+            (starting from the end so that the row numbers remain valid)
+        """
+        blocks = []
+        for row in rows:
+            if blocks and blocks[-1][1] == row - 1:
+                blocks[-1][1] = row
+            else:
+                blocks.append([row, row])
+
+        for first, last in reversed(blocks):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            del self._rows[first:last + 1]
+            self._store.remove(first, last)
+            self.endRemoveRows()
+
+    def refreshRecords(self, recordIds):
+        """ Re-read the records from the database and update the rows in place,
+            without having to select the whole model again
+        """
+        positions = np.flatnonzero(np.isin(self._store.recordIds, list(recordIds)))
+
+        if not len(positions):
+            return True
+
+        query = QtSql.QSqlQuery()
+        query.setForwardOnly(True)
+        query.prepare(self.selectStatement(
+            'AND r.recordid IN (%s)' % ','.join(str(int(self._store.recordIds[row])) for row in positions)))
+        query.addBindValue(db.userId)
+
+        if not query.exec_():
+            self._lastError = query.lastError()
+            _log.error('Failed to refresh records: %s', self._lastError.text())
             return False
 
-        self.select()
-        self.dataChanged.emit(indexes[0], indexes[-1])
+        numColumns = query.record().count()
+        records = {}
+
+        while query.next():
+            record = [query.value(column) for column in range(numColumns)]
+            records[record[enum.kRecords_RecordId]] = record
+
+        updated = [int(row) for row in positions if int(self._store.recordIds[row]) in records]
+        rows = [records[int(self._store.recordIds[row])] for row in updated]
+        changedColumns = set()
+
+        for row, record in zip(updated, rows):
+            changedColumns.update(
+                column for column, value in enumerate(record) if value != self._rows[row][column])
+            self._rows[row] = record
+        self._store.update(updated, rows)
+
+        if changedColumns:
+            self.dataChanged.emit(
+                self.index(updated[0], min(changedColumns)),
+                self.index(updated[-1], max(changedColumns))
+            )
 
+        # Records no longer in the database
+        self.__removeRows([int(row) for row in positions if int(self._store.recordIds[row]) not in records])
         return True
 
     def highlightText(self, text):
@@ -101,15 +352,22 @@ class RecordModel(QtSql.QSqlTableModel):
         """
         self._highlightText = text
 
+    def _value(self, row, column):
+        """ Returns the value read from the database for row and column
+        """
+        return self._rows[row][column]
+
     def data(self, item, role=QtCore.Qt.DisplayRole):
         """ Return data from the model, formatted for viewing
         """
         if not item.isValid():
             return None
 
+        value = self._value(item.row(), item.column())
+
         if role == QtCore.Qt.CheckStateRole:
             if item.column() == enum.kRecords_Checked:
-                if super(RecordModel, self).data(item):
+                if value:
                     return QtCore.Qt.Checked
                 else:
                     return QtCore.Qt.Unchecked
@@ -128,38 +386,35 @@ class RecordModel(QtSql.QSqlTableModel):
 
             elif item.column() == enum.kRecords_Checked:
                 if item.data(QtCore.Qt.CheckStateRole) == QtCore.Qt.Checked:
-                    text = "Checked: " + super(RecordModel, self).data(
-                        self.index(item.row(), enum.kRecords_CheckDate)).toString("dd/MM/yy hh:mm")
+                    text = "Checked: " + self._value(item.row(), enum.kRecords_CheckDate).toString("dd/MM/yy hh:mm")
                     return text
 
             elif item.column() == enum.kRecords_Date:
                 # Show when the record was imported
-                text = "Imported: " + super(RecordModel, self).data(
-                    self.index(item.row(), enum.kRecords_InsertDate)).toString("dd/MM/yy hh:mm")
+                text = "Imported: " + self._value(item.row(), enum.kRecords_InsertDate).toString("dd/MM/yy hh:mm")
                 return text
 
             elif item.column() == enum.kRecords_Description:
                 # Full, raw text
-                return super(RecordModel, self).data(item, QtCore.Qt.DisplayRole)
+                return value
 
         elif role == QtCore.Qt.UserRole:
             if item.column() == enum.kRecords_Tags:
-                # Tags as "##" separated string (from database)
-                tags = super(RecordModel, self).data(item, QtCore.Qt.DisplayRole)
-                return tags.split('##') if tags else []
+                # Tag names, as split by the store
+                return list(self._store.tags[item.row()])
 
             elif item.column() == enum.kRecords_Amount:
                 # signed float
-                return super(RecordModel, self).data(item, QtCore.Qt.DisplayRole)
+                return value
 
             elif item.column() == enum.kRecords_Date:
                 # QDate object
-                return super(RecordModel, self).data(item, QtCore.Qt.DisplayRole)
+                return value
 
         elif role == QtCore.Qt.ForegroundRole:
             if item.column() == enum.kRecords_Amount:
                 # Indicate credit/debit with colour
-                if item.data(QtCore.Qt.UserRole) > 0.0:
+                if value > 0.0:
                     return QtGui.QColor(0, 255, 0)
                 else:
                     return QtGui.QColor(255, 0, 0)
@@ -167,29 +422,31 @@ class RecordModel(QtSql.QSqlTableModel):
         elif role == QtCore.Qt.DecorationRole:
             if item.column() == enum.kRecords_Tags:
                 # Show tag icon if we have any
-                if item.data(QtCore.Qt.UserRole):
+                if value:
                     return QtGui.QIcon(':/icons/tag_yellow.png')
 
-        elif role == QtCore.Qt.DisplayRole:
+        elif role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
             if item.column() in (enum.kRecords_Checked, enum.kRecords_Tags):
                 # Don't display anything for these fields
                 return None
 
             elif item.column() == enum.kRecords_Amount:
                 # Display absolute currency values. credit/debit is indicated by background colour
-                code = self.index(item.row(), enum.kRecords_Currency).data()
-                return currency.toCurrencyStr(abs(super(RecordModel, self).data(item)), code)
+                code = self._value(item.row(), enum.kRecords_Currency)
+                return currency.toCurrencyStr(abs(value), code)
 
             elif item.column() == enum.kRecords_Description:
                 # Replace multiple spaces with single
-                return re.sub('[ ]+', ' ', super(RecordModel, self).data(item))
+                return re.sub('[ ]+', ' ', value)
 
             elif item.column() == enum.kRecords_Date:
                 # Ensure date display is day/month/year, or I'll get confused.
                 # Use UserRole to return QDate object
-                return super(RecordModel, self).data(item, role).toString('dd/MM/yyyy')
+                return value.toString('dd/MM/yyyy')
+
+            return value
 
-        return super(RecordModel, self).data(item, role)
+        return None
 
     def toggleChecked(self, indexes):
         checkedRecords = []
@@ -225,11 +482,7 @@ class RecordModel(QtSql.QSqlTableModel):
                 if not query.execBatch(QtSql.QSqlQuery.ValuesAsColumns):
                     raise Exception(query.lastError().text())
 
-        self.select()
-
-        for index in indexes:
-            checkedIndex = self.index(index.row(), enum.kRecords_Checked)
-            self.dataChanged.emit(checkedIndex, checkedIndex)
+        self.refreshRecords(checkedRecords + unCheckedRecords)
 
     @utils.showWaitCursorDecorator
     def setData(self, index, value, role=QtCore.Qt.EditRole):
@@ -259,20 +512,75 @@ class RecordModel(QtSql.QSqlTableModel):
                 return "Amount"
 
 
-class RecordProxyModel(QtCore.QSortFilterProxyModel):
+class RecordProxyModel(QtCore.QAbstractProxyModel):
     """ Proxy model for records table. Allows for fast filtering without the expense
-        of extra SQL queries
+        of extra SQL queries. Each filter is a boolean mask over the source model's
+        RecordStore, and the proxy rows are mapped from the combined mask
     """
     # pyqtSignal emitted whenever there is a change to the filter
     filterChanged = QtCore.pyqtSignal()
 
+    __sqlOperators = {
+        operator.eq: '=',
+        operator.gt: '>',
+        operator.lt: '<',
+        operator.ge: '>=',
+        operator.le: '<=',
+    }
+
+    __filterNames = (
+        'date', 'insertDate', 'account', 'hasTags', 'checked',
+        'credit', 'description', 'amount', 'tags',
+    )
+
+    # Columns where an ascending sort shows the largest values first
+    __reversedColumns = (
+        enum.kRecords_Tags, enum.kRecords_Checked, enum.kRecords_Amount, enum.kRecords_Date,
+    )
+
     def __init__(self, parent=None):
         super(RecordProxyModel, self).__init__(parent=parent)
+        self._serverSide = False
+        self._sortColumn = -1
+        self._sortOrder = QtCore.Qt.AscendingOrder
+        self._sourceRows = np.empty(0, dtype=np.intp)
+        self._proxyRows = np.empty(0, dtype=np.intp)
+        self._countedAmounts = np.empty(0, dtype=np.float64)
+        self._inTotal = 0.0
+        self._outTotal = 0.0
         self.__reset()
 
+    def setSourceModel(self, model):
+        self.beginResetModel()
+        super(RecordProxyModel, self).setSourceModel(model)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self.__sourceReset)
+        model.dataChanged.connect(self.__sourceDataChanged)
+        model.rowsAboutToBeInserted.connect(self.__sourceRowsAboutToBeInserted)
+        model.rowsInserted.connect(self.__sourceRowsInserted)
+        model.rowsAboutToBeRemoved.connect(self.__sourceRowsAboutToBeRemoved)
+        model.rowsRemoved.connect(self.__sourceRowsRemoved)
+        self.__mapRows()
+        self.__countRows()
+        self.endResetModel()
+
+    def setServerSideFiltering(self, enabled):
+        """ When enabled the filters are applied in SQL and the source model
+            only reads the matching records, in windows as the view scrolls.
+            Note that the source model needs to be re-selected
+        """
+        self._serverSide = enabled
+        self.sourceModel().setPaging(enabled)
+        self.sourceModel().setRecordFilter(*self.filterClause())
+
+    def isServerSideFiltering(self):
+        return self._serverSide
+
     def reset(self):
         self.beginResetModel()
         self.__reset()
+        self.__mapRows()
+        self.__countRows()
         self.endResetModel()
 
     def __reset(self):
@@ -289,6 +597,7 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         self._amountFilter = None
         self._tagFilter = None
         self._amountOperator = None
+        self._masks = {}
 
     def clearFilters(self):
         """ Clears all filters - does *not* call invalidate
@@ -299,24 +608,24 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         self._startDate = None
         self._endDate = None
         self._insertDate = insertDate
-        self.invalidateFilter()
+        self.invalidateFilter('date', 'insertDate')
 
     def setStartDate(self, date):
         _log.debug("setStartDate {}".format(date))
         self._insertDate = None
         self._startDate = date
-        self.invalidateFilter()
+        self.invalidateFilter('date', 'insertDate')
 
     def setEndDate(self, date):
         _log.debug("setStartEnd {}".format(date))
         self._insertDate = None
         self._endDate = date
-        self.invalidateFilter()
+        self.invalidateFilter('date', 'insertDate')
 
     def setAccountFilter(self, accountIds):
         if accountIds != self._accountids:
             self._accountids = accountIds
-            self.invalidateFilter()
+            self.invalidateFilter('account')
 
     def setHasTagsFilter(self, value):
         """ Set basic tag filter
@@ -328,13 +637,13 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         """
         if value != self._hasTags:
             self._hasTags = value
-            self.invalidateFilter()
+            self.invalidateFilter('hasTags')
 
     def setTagFilter(self, tags):
         _log.debug("setTagFilter %r", tags)
         if tags != self._tagFilter:
             self._tagFilter = tags[:]
-            self.invalidateFilter()
+            self.invalidateFilter('tags')
 
     def setCheckedFilter(self, value):
         """ Checked records filter
@@ -346,7 +655,7 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         """
         if value != self._checked:
             self._checked = value
-            self.invalidateFilter()
+            self.invalidateFilter('checked')
 
     def setCreditFilter(self, value):
         """ Credit amount filter
@@ -358,14 +667,14 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         """
         if value != self._creditFilter:
             self._creditFilter = value
-            self.invalidateFilter()
+            self.invalidateFilter('credit')
 
     def setDescriptionFilter(self, text):
         """ Filter by description (case insensitive)
         """
         if text != self._description:
             self._description = text.lower()
-            self.invalidateFilter()
+            self.invalidateFilter('description')
 
     def setAmountFilter(self, text, op=None):
         """ Set amount filter with optional operator
@@ -374,102 +683,354 @@ class RecordProxyModel(QtCore.QSortFilterProxyModel):
         if text != self._amountFilter or op != self._amountOperator:
             self._amountFilter = text
             self._amountOperator = op
-            self.invalidateFilter()
+            self.invalidateFilter('amount')
 
-    def invalidateFilter(self):
-        """ Override invalidateFilter so that we can emit the filterChanged signal
+    def invalidateFilter(self, *filterNames):
+        """ Re-apply the named filters, or all of them if no names are
+            given, and emit the filterChanged signal
         """
-        super(RecordProxyModel, self).invalidateFilter()
-        self.sort(self.sortColumn(), self.sortOrder())
+        if self._serverSide:
+            self.sourceModel().setRecordFilter(*self.filterClause())
+            self.sourceModel().select()
+        else:
+            for name in filterNames or self.__filterNames:
+                self._masks[name] = self.__mask(name)
+            self.__updateRows()
+            self.__countRows()
         self.filterChanged.emit()
 
-    def filterAcceptsRow(self, sourceRow, parent):
-        """ Filters row to display
+    def __mask(self, name):
+        """ Returns the mask of source rows accepted by the named filter,
+            or None if the filter is not set
         """
+        store = self.sourceModel().store()
+
+        if name == 'date':
+            if self._startDate or self._endDate:
+                return store.dateMask(self._startDate, self._endDate)
+
+        elif name == 'insertDate':
+            if self._insertDate:
+                return store.insertDateMask(self._insertDate)
+
+        elif name == 'account':
+            if self._accountids:
+                return store.accountMask(self._accountids)
+
+        elif name == 'hasTags':
+            if self._hasTags is not None:
+                return store.hasTagsMask(self._hasTags)
+
+        elif name == 'checked':
+            if self._checked is not None:
+                return store.checkedMask(self._checked)
+
+        elif name == 'credit':
+            if self._creditFilter is not None:
+                return store.creditMask(self._creditFilter)
+
+        elif name == 'description':
+            if self._description:
+                return store.descriptionMask(self._description)
+
+        elif name == 'amount':
+            if self._amountFilter:
+                return store.amountMask(self._amountFilter, self._amountOperator)
+
+        elif name == 'tags':
+            if self._tagFilter:
+                return store.tagMask(self._tagFilter)
+
+        return None
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """ Sort the filtered rows, or let the source model order the
+            records if filtering on the server
+        """
+        self._sortColumn = column
+        self._sortOrder = order
+
+        if self._serverSide:
+            self.sourceModel().sort(column, order)
+        else:
+            self.__updateRows()
+
+    def sortColumn(self):
+        return self._sortColumn
+
+    def filterMask(self):
+        """ Returns the mask of source rows shown by the proxy
+        """
+        return self._proxyRows >= 0
+
+    def sortOrder(self):
+        return self._sortOrder
+
+    def totals(self):
+        """ Returns the in and out totals of the amounts in the proxy rows
+        """
+        return self._inTotal, self._outTotal
+
+    def filterClause(self):
+        """ Returns the current filters as an SQL condition on the records
+            table (r), along with the list of values to bind
+        """
+        clauses = []
+        values = []
+
         if self._startDate:
-            if self.sourceModel().index(sourceRow, enum.kRecords_Date, parent).data(QtCore.Qt.UserRole) < self._startDate:
-                return False
+            clauses.append('r.date >= ?')
+            values.append(self._startDate)
 
         if self._endDate:
-            if self.sourceModel().index(sourceRow, enum.kRecords_Date, parent).data(QtCore.Qt.UserRole) > self._endDate:
-                return False
+            clauses.append('r.date <= ?')
+            values.append(self._endDate)
 
         if self._insertDate:
-            if self.sourceModel().index(sourceRow, enum.kRecords_InsertDate, parent).data() != self._insertDate:
-                return False
+            clauses.append('r.insertdate = ?')
+            values.append(self._insertDate)
 
         if self._accountids:
-            if self.sourceModel().index(sourceRow, enum.kRecords_AccountId).data() not in self._accountids:
-                return False
+            clauses.append('r.accountid IN (%s)' % ', '.join('?' * len(self._accountids)))
+            values.extend(self._accountids)
 
         if self._hasTags is not None:
-            hasTags = bool(self.sourceModel().index(sourceRow, enum.kRecords_Tags).data(QtCore.Qt.UserRole))
-            if self._hasTags != hasTags:
-                return False
+            clauses.append('%sEXISTS (SELECT 1 FROM recordtags rt WHERE rt.recordid=r.recordid)' % (
+                '' if self._hasTags else 'NOT '))
 
         if self._checked is not None:
-            isChecked = self.sourceModel().index(sourceRow, enum.kRecords_Checked).data(QtCore.Qt.CheckStateRole) == QtCore.Qt.Checked
-            if self._checked != isChecked:
-                return False
+            clauses.append('r.checked %s 0' % ('<>' if self._checked else '='))
 
         if self._creditFilter is not None:
-            amount = self.sourceModel().index(sourceRow, enum.kRecords_Amount).data(QtCore.Qt.UserRole)
-            if self._creditFilter != (amount >= 0.0):
-                return False
+            clauses.append('r.amount %s 0' % ('>=' if self._creditFilter else '<'))
 
         if self._description:
-            description = self.sourceModel().index(sourceRow, enum.kRecords_Description).data()
             try:
-                if not re.search(self._description, description, re.IGNORECASE):
-                  return False
-            except Exception as exc:
+                # Same as the client side filter - an invalid expression matches everything
+                re.compile(self._description)
+            except re.error:
                 pass
+            else:
+                clauses.append('r.description ~* ?')
+                values.append(self._description)
 
         if self._amountFilter:
-            amount = self.sourceModel().index(sourceRow, enum.kRecords_Amount).data(QtCore.Qt.UserRole)
             if self._amountOperator is None:
-                if self._amountFilter not in '{:.2f}'.format(amount):
-                    return False
+                clauses.append('strpos(r.amount::text, ?) > 0')
+                values.append(self._amountFilter)
             else:
-                # Use operator to perform match
-                if not self._amountOperator(abs(float(amount)), float(self._amountFilter)):
-                    return False
+                clauses.append('ABS(r.amount) %s ?' % self.__sqlOperators[self._amountOperator])
+                values.append(float(self._amountFilter))
 
         if self._tagFilter:
-            tags = self.sourceModel().index(sourceRow, enum.kRecords_Tags).data(QtCore.Qt.UserRole)
-            if not set(self._tagFilter).intersection(set(tags)):
-                return False
+            clauses.append("""EXISTS (
+                SELECT 1
+                  FROM recordtags rt
+            INNER JOIN tags t
+                    ON t.tagid=rt.tagid
+                 WHERE rt.recordid=r.recordid
+                   AND t.tagname IN (%s))""" % ', '.join('?' * len(self._tagFilter)))
+            values.extend(self._tagFilter)
+
+        return ' AND '.join(clauses), values
+
+    def __sortRows(self, mask):
+        """ Returns the source rows accepted by mask in the current sort order
+        """
+        descending = (self._sortColumn in self.__reversedColumns) != (self._sortOrder == QtCore.Qt.DescendingOrder)
+        order = self.sourceModel().store().sortOrder(self._sortColumn, descending)
 
-        return True
+        if order is None:
+            return np.flatnonzero(mask)
+
+        return order[mask[order]]
+
+    def __acceptedMask(self):
+        """ Returns the mask of source rows accepted by all filters
+        """
+        mask = np.ones(self.sourceModel().rowCount(), dtype=bool)
+        for filterMask in self._masks.values():
+            if filterMask is not None:
+                mask &= filterMask
+        return mask
+
+    def __mapRows(self, sourceRows=None):
+        """ Create the mapping between proxy and source rows, from the
+            filters and sort order if sourceRows is not given
+        """
+        numRows = self.sourceModel().rowCount() if self.sourceModel() else 0
+
+        if sourceRows is not None:
+            pass
+        elif self._serverSide:
+            # Source model only has matching rows, in order
+            sourceRows = np.arange(numRows, dtype=np.intp)
+        else:
+            sourceRows = self.__sortRows(self.__acceptedMask())
+
+        self._sourceRows = sourceRows
+        self._proxyRows = np.full(numRows, -1, dtype=np.intp)
+        self._proxyRows[sourceRows] = np.arange(len(sourceRows), dtype=np.intp)
+
+    def __addTotals(self, amounts, sign=1):
+        self._inTotal += sign * float(amounts[amounts > 0.0].sum())
+        self._outTotal -= sign * float(amounts[amounts < 0.0].sum())
+
+    def __countRows(self, rows=None):
+        """ Update the totals after the proxy rows have been mapped. Only
+            the source rows given are counted again, or all rows if None
+        """
+        amounts = self.sourceModel().store().amounts if self.sourceModel() else np.empty(0, dtype=np.float64)
+
+        if rows is None:
+            self._countedAmounts = np.where(self._proxyRows >= 0, amounts, 0.0)
+            self._inTotal = self._outTotal = 0.0
+            self.__addTotals(self._countedAmounts)
+            return
+
+        self.__addTotals(self._countedAmounts[rows], -1)
+        self._countedAmounts[rows] = np.where(self._proxyRows[rows] >= 0, amounts[rows], 0.0)
+        self.__addTotals(self._countedAmounts[rows])
 
-    def lessThan(self, left, right):
-        """ Define the comparison to ensure column data is sorted correctly
+    def __persistentSourceRows(self):
+        """ Returns the persistent indexes and their source rows
+        """
+        indexes = self.persistentIndexList()
+        return indexes, [int(self._sourceRows[index.row()]) for index in indexes]
+
+    def __changePersistentRows(self, indexes, sourceRows):
+        """ Move the persistent indexes to the new proxy rows of sourceRows.
+            A source row of -1 means the row has gone
+        """
+        self.changePersistentIndexList(indexes, [
+            self.index(int(self._proxyRows[sourceRow]) if sourceRow >= 0 else -1, index.column())
+                for sourceRow, index in zip(sourceRows, indexes)
+        ])
+
+    def __updateRows(self, sourceRows=None):
+        """ Re-map the rows after a change to the filter or sort order,
+            keeping any persistent indexes (eg the selection)
         """
-        leftVal = None
-        rightVal = None
+        self.layoutAboutToBeChanged.emit()
+        indexes, persistentRows = self.__persistentSourceRows()
+        self.__mapRows(sourceRows)
+        self.__changePersistentRows(indexes, persistentRows)
+        self.layoutChanged.emit()
+
+    def __sourceReset(self):
+        if not self._serverSide:
+            self._masks = dict((name, self.__mask(name)) for name in self.__filterNames)
+        self.__mapRows()
+        self.__countRows()
+        self.endResetModel()
+
+    def __sourceDataChanged(self, topLeft, bottomRight, roles=[]):
+        if not self._serverSide:
+            # Changed rows might no longer match the filters, or be out of order
+            for name, mask in self._masks.items():
+                if mask is not None:
+                    self._masks[name] = self.__mask(name)
+
+            mask = self.__acceptedMask()
+            if not np.array_equal(mask, self._proxyRows >= 0) or \
+                    topLeft.column() <= self._sortColumn <= bottomRight.column():
+                self.__updateRows(self.__sortRows(mask))
+
+        # Only the changed rows can have different amounts or have been filtered in or out
+        self.__countRows(np.arange(topLeft.row(), bottomRight.row() + 1))
+
+        rows = self._proxyRows[topLeft.row():bottomRight.row() + 1]
+        rows = rows[rows >= 0]
+
+        if len(rows):
+            self.dataChanged.emit(
+                self.index(int(rows.min()), topLeft.column()),
+                self.index(int(rows.max()), bottomRight.column()),
+                roles
+            )
+
+    def __sourceRowsAboutToBeRemoved(self, parent, first, last):
+        if self._serverSide:
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            return
+
+        # Removed rows are scattered in the proxy - remove each run of
+        # consecutive proxy rows, starting from the end
+        proxyRows = np.sort(self._proxyRows[first:last + 1])
+        proxyRows = proxyRows[proxyRows >= 0]
+
+        for run in reversed(np.split(proxyRows, np.flatnonzero(np.diff(proxyRows) != 1) + 1)):
+            if len(run):
+                self.beginRemoveRows(QtCore.QModelIndex(), int(run[0]), int(run[-1]))
+                self.__mapRows(np.delete(self._sourceRows, np.s_[run[0]:run[-1] + 1]))
+                self.endRemoveRows()
+
+    def __sourceRowsRemoved(self, parent, first, last):
+        self.__addTotals(self._countedAmounts[first:last + 1], -1)
+        self._countedAmounts = np.delete(self._countedAmounts, np.s_[first:last + 1])
+
+        if self._serverSide:
+            self.__mapRows()
+            self.endRemoveRows()
+            return
+
+        for name, mask in self._masks.items():
+            if mask is not None:
+                self._masks[name] = np.delete(mask, np.s_[first:last + 1])
+
+        # The removed rows are no longer mapped, and the proxy rows stay the same
+        count = last - first + 1
+        self.__mapRows(np.where(self._sourceRows > last, self._sourceRows - count, self._sourceRows))
+
+    def __sourceRowsAboutToBeInserted(self, parent, first, last):
+        # Rows are only appended when reading windows with server-side filtering
+        if self._serverSide:
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+
+    def __sourceRowsInserted(self, parent, first, last):
+        if self._serverSide:
+            self.__mapRows()
+            self._countedAmounts = np.concatenate((self._countedAmounts, np.zeros(last - first + 1)))
+            self.__countRows(np.arange(first, last + 1))
+            self.endInsertRows()
+        else:
+            self.invalidateFilter()
+
+    def mapToSource(self, proxyIndex):
+        if not proxyIndex.isValid():
+            return QtCore.QModelIndex()
+
+        return self.sourceModel().index(int(self._sourceRows[proxyIndex.row()]), proxyIndex.column())
+
+    def mapFromSource(self, sourceIndex):
+        if not sourceIndex.isValid() or sourceIndex.row() >= len(self._proxyRows):
+            return QtCore.QModelIndex()
+
+        return self.index(int(self._proxyRows[sourceIndex.row()]), sourceIndex.column())
 
-        if left.column() == enum.kRecords_Tags:
-            leftVal = len(left.data(QtCore.Qt.UserRole))
-            rightVal = len(right.data(QtCore.Qt.UserRole))
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if parent.isValid() or not 0 <= row < self.rowCount() or not 0 <= column < self.columnCount():
+            return QtCore.QModelIndex()
 
-        elif left.column() == enum.kRecords_Checked:
-            leftVal = left.data(QtCore.Qt.CheckStateRole)
-            rightVal = right.data(QtCore.Qt.CheckStateRole)
+        return self.createIndex(row, column)
 
-        elif left.column() == enum.kRecords_Amount:
-            leftVal = left.data(QtCore.Qt.UserRole)
-            rightVal = right.data(QtCore.Qt.UserRole)
+    def sibling(self, row, column, index):
+        return self.index(row, column)
 
-        elif left.column() == enum.kRecords_Date:
-            leftVal =  left.data(QtCore.Qt.UserRole)
-            rightVal = right.data(QtCore.Qt.UserRole)
+    def parent(self, index):
+        return QtCore.QModelIndex()
 
-            if leftVal == rightVal:
-                # Dates are the same - sort by recordId just to ensure the results are consistent
-                leftVal = self.sourceModel().index(left.row(), enum.kRecords_RecordId).data(QtCore.Qt.UserRole)
-                rightVal = self.sourceModel().index(right.row(), enum.kRecords_RecordId).data(QtCore.Qt.UserRole)
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._sourceRows)
 
-        if leftVal or rightVal:
-            return leftVal > rightVal
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid() or not self.sourceModel():
+            return 0
+        return self.sourceModel().columnCount()
 
-        return super(RecordProxyModel, self).lessThan(left, right)
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Vertical:
+            section = int(self._sourceRows[section]) if 0 <= section < len(self._sourceRows) else section
+        return self.sourceModel().headerData(section, orientation, role)
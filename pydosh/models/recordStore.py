@@ -0,0 +1,328 @@
+import re
+import numpy as np
+
+from pydosh import enum
+
+
+class RecordStore(object):
+    """ Columnar copy of the records read by RecordModel. Filters are
+        computed as boolean masks over the columns, so the proxy model
+        doesn't need to call back into the model for every row.
+
+        Tags are indexed as a flat list of assignments: tagIds[i] (an index
+        into tagNames) is assigned to the record at row tagRows[i]
+    """
+    # Initial number of rows the column buffers have room for
+    minCapacity = 1024
+
+    # Array columns and their types. Each is kept in a buffer with room to
+    # grow, so reading another window of records only copies the new rows
+    __arrays = (
+        ('recordIds', np.int64),
+        ('dates', np.int32),
+        ('amounts', np.float64),
+        ('accountIds', np.int64),
+        ('checked', bool),
+        ('insertDates', np.int64),
+        ('descriptionCodes', np.intp),
+        ('tagCounts', np.int32),
+    )
+    __lists = ('tags', 'accountNames')
+
+    def __init__(self, rows=()):
+        super(RecordStore, self).__init__()
+        self._size = 0
+        self._buffers = dict((name, np.empty(0, dtype=dtype)) for name, dtype in self.__arrays)
+        self.descriptions = []
+        self.tags = []
+        self.tagNames = []
+        self._tagNameIds = {}
+        self._numTagged = 0
+        self._tagIdBuffer = np.empty(0, dtype=np.int32)
+        self._tagRowBuffer = np.empty(0, dtype=np.intp)
+        self.accountNames = []
+        self._descriptionCodes = {}
+        self._uniqueDescriptions = []
+        self._sortOrders = {}
+        self.__setViews()
+        self.append(rows)
+
+    def __len__(self):
+        return self._size
+
+    def __setViews(self):
+        """ Point the column attributes at the used part of their buffers
+        """
+        for name, _ in self.__arrays:
+            setattr(self, name, self._buffers[name][:self._size])
+
+        self.tagIds = self._tagIdBuffer[:self._numTagged]
+        self.tagRows = self._tagRowBuffer[:self._numTagged]
+
+    def __reserve(self, size):
+        """ Make sure the buffers have room for size rows, doubling them if not
+        """
+        capacity = len(self._buffers['recordIds'])
+
+        if size <= capacity:
+            return
+
+        capacity = max(size, capacity * 2, self.minCapacity)
+
+        for name, dtype in self.__arrays:
+            buffer = np.empty(capacity, dtype=dtype)
+            buffer[:self._size] = self._buffers[name][:self._size]
+            self._buffers[name] = buffer
+
+    def __columns(self, rows):
+        """ Returns a dict of column name to values for the rows
+        """
+        tags = [tuple(row[enum.kRecords_Tags].split('##')) if row[enum.kRecords_Tags] else () for row in rows]
+
+        return {
+            'recordIds': np.array([row[enum.kRecords_RecordId] for row in rows], dtype=np.int64),
+            'dates': np.array([row[enum.kRecords_Date].toJulianDay() for row in rows], dtype=np.int32),
+            'amounts': np.array([row[enum.kRecords_Amount] for row in rows], dtype=np.float64),
+            'accountIds': np.array([row[enum.kRecords_AccountId] for row in rows], dtype=np.int64),
+            'checked': np.array([bool(row[enum.kRecords_Checked]) for row in rows], dtype=bool),
+            'insertDates': np.array([self.__msecs(row[enum.kRecords_InsertDate]) for row in rows], dtype=np.int64),
+            'descriptionCodes': self.__internDescriptions([row[enum.kRecords_Description] for row in rows]),
+            'tagCounts': np.array([len(names) for names in tags], dtype=np.int32),
+            'tags': tags,
+            'accountNames': [row[enum.kRecords_AccountTypeName] for row in rows],
+        }
+
+    def append(self, rows):
+        """ Add rows, as read from the database, to the end of the store
+        """
+        if not rows:
+            return
+
+        columns = self.__columns(rows)
+        first = self._size
+        self.__reserve(first + len(rows))
+
+        for name, _ in self.__arrays:
+            self._buffers[name][first:first + len(rows)] = columns[name]
+
+        self._size += len(rows)
+
+        for name in self.__lists:
+            getattr(self, name).extend(columns[name])
+
+        self.__indexTags(np.arange(first, self._size), columns['tags'])
+        self._sortOrders.clear()
+
+    def update(self, positions, rows):
+        """ Replace the values at positions (indexes into the store) with rows
+        """
+        if not rows:
+            return
+
+        columns = self.__columns(rows)
+
+        for name, _ in self.__arrays:
+            getattr(self, name)[positions] = columns[name]
+
+        for name in self.__lists:
+            values = getattr(self, name)
+            for position, value in zip(positions, columns[name]):
+                values[position] = value
+
+        positions = np.asarray(positions, dtype=np.intp)
+        self.__keepTags(~np.isin(self.tagRows, positions))
+        self.__indexTags(positions, columns['tags'])
+        self._sortOrders.clear()
+
+    def remove(self, first, last):
+        """ Remove the values from first to last, inclusive
+        """
+        count = last - first + 1
+
+        for name, _ in self.__arrays:
+            buffer = self._buffers[name]
+            buffer[first:self._size - count] = buffer[last + 1:self._size]
+
+        self._size -= count
+
+        for name in self.__lists:
+            del getattr(self, name)[first:last + 1]
+
+        self.__keepTags((self.tagRows < first) | (self.tagRows > last))
+        self.tagRows[self.tagRows > last] -= count
+        self._sortOrders.clear()
+
+    def __indexTags(self, positions, tags):
+        """ Add the tag names of the rows at positions to the tag index
+        """
+        tagIds = []
+
+        for names in tags:
+            for name in names:
+                if name not in self._tagNameIds:
+                    self._tagNameIds[name] = len(self.tagNames)
+                    self.tagNames.append(name)
+                tagIds.append(self._tagNameIds[name])
+
+        first = self._numTagged
+        self._numTagged += len(tagIds)
+
+        if self._numTagged > len(self._tagIdBuffer):
+            capacity = max(self._numTagged, len(self._tagIdBuffer) * 2, self.minCapacity)
+            self._tagIdBuffer = np.resize(self._tagIdBuffer, capacity)
+            self._tagRowBuffer = np.resize(self._tagRowBuffer, capacity)
+
+        self._tagIdBuffer[first:self._numTagged] = tagIds
+        self._tagRowBuffer[first:self._numTagged] = np.repeat(positions, [len(names) for names in tags])
+        self.__setViews()
+
+    def __keepTags(self, keep):
+        """ Remove the entries of the tag index not set in keep
+        """
+        self._numTagged = int(np.count_nonzero(keep))
+        self._tagIdBuffer[:self._numTagged] = self.tagIds[keep]
+        self._tagRowBuffer[:self._numTagged] = self.tagRows[keep]
+        self.__setViews()
+
+    def __internDescriptions(self, descriptions):
+        """ Returns the codes of descriptions, adding any not seen before. Text
+            filters only need to look at each distinct description once
+        """
+        codes = self._descriptionCodes
+
+        for description in descriptions:
+            if description not in codes:
+                codes[description] = len(self.descriptions)
+                self.descriptions.append(re.sub('[ ]+', ' ', description))
+                self._uniqueDescriptions.append(description)
+
+        return np.fromiter((codes[description] for description in descriptions), dtype=np.intp, count=len(descriptions))
+
+    @staticmethod
+    def __msecs(dateTime):
+        return dateTime.toMSecsSinceEpoch() if dateTime and dateTime.isValid() else -1
+
+    def dateMask(self, startDate=None, endDate=None):
+        """ Records between startDate and endDate (QDate), inclusive
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if startDate:
+            mask &= self.dates >= startDate.toJulianDay()
+        if endDate:
+            mask &= self.dates <= endDate.toJulianDay()
+        return mask
+
+    def insertDateMask(self, insertDate):
+        """ Records imported at insertDate (QDateTime)
+        """
+        return self.insertDates == self.__msecs(insertDate)
+
+    def accountMask(self, accountIds):
+        return np.isin(self.accountIds, list(accountIds))
+
+    def hasTagsMask(self, hasTags):
+        return (self.tagCounts > 0) == hasTags
+
+    def checkedMask(self, checked):
+        return self.checked == checked
+
+    def creditMask(self, credit):
+        return (self.amounts >= 0.0) == credit
+
+    def descriptionMask(self, pattern):
+        """ Records with description matching the regular expression (case insensitive).
+            Returns None if the pattern is not valid
+        """
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            return None
+
+        matches = np.array([bool(regex.search(description)) for description in self.descriptions], dtype=bool)
+        return matches[self.descriptionCodes]
+
+    def amountMask(self, text, op=None):
+        """ Records with absolute amount matching text using op, or if
+            op is None those where the amount (2 decimal places) contains text
+        """
+        if op is not None:
+            return op(np.abs(self.amounts), float(text))
+
+        uniques, codes = np.unique(self.amounts, return_inverse=True)
+        matches = np.array([text in '{:.2f}'.format(amount) for amount in uniques], dtype=bool)
+        return matches[codes]
+
+    def tagMask(self, tagNames):
+        """ Records that have any of the tags
+        """
+        tagIds = [self._tagNameIds[name] for name in set(tagNames) if name in self._tagNameIds]
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.tagRows[np.isin(self.tagIds, tagIds)]] = True
+        return mask
+
+    def tagTotals(self, mask):
+        """ Returns arrays of the in and out totals of the records in mask
+            for each tag, indexed by tag id
+        """
+        visible = mask[self.tagRows]
+        tagIds = self.tagIds[visible]
+        amounts = self.amounts[self.tagRows[visible]]
+
+        return (
+            np.bincount(tagIds, weights=np.where(amounts > 0.0, amounts, 0.0), minlength=len(self.tagNames)),
+            -np.bincount(tagIds, weights=np.where(amounts < 0.0, amounts, 0.0), minlength=len(self.tagNames))
+        )
+
+    def tagRecordIds(self, mask):
+        """ Returns a list of the ids of the records in mask for each tag, indexed by tag id
+        """
+        if not self.tagNames:
+            return []
+
+        visible = mask[self.tagRows]
+        tagIds = self.tagIds[visible]
+        order = np.argsort(tagIds, kind='stable')
+        counts = np.bincount(tagIds, minlength=len(self.tagNames))
+        return np.split(self.recordIds[self.tagRows[visible][order]], np.cumsum(counts)[:-1])
+
+    def sortKeys(self, column):
+        """ Returns a list of key arrays for column, most significant last
+            (as np.lexsort), or None if the column can't be sorted
+        """
+        if column == enum.kRecords_Date:
+            return [self.recordIds, self.dates]
+        elif column == enum.kRecords_Amount:
+            return [self.amounts]
+        elif column == enum.kRecords_Checked:
+            return [self.checked]
+        elif column == enum.kRecords_Tags:
+            return [self.tagCounts]
+        elif column == enum.kRecords_Description:
+            # Codes are in the order descriptions were first seen - sort on their rank
+            ranks = np.empty(len(self._uniqueDescriptions), dtype=np.intp)
+            ranks[np.argsort(np.array(self._uniqueDescriptions, dtype=object), kind='stable')] = \
+                np.arange(len(ranks))
+            return [ranks[self.descriptionCodes]]
+        elif column == enum.kRecords_AccountTypeName:
+            return [np.unique(np.array(self.accountNames, dtype=object), return_inverse=True)[1]]
+        return None
+
+    def sortOrder(self, column, descending=False):
+        """ Returns the permutation of all rows sorted on column, or None if
+            the column can't be sorted. Permutations are kept until the
+            store changes, so sorting a filtered subset is only a lookup
+        """
+        key = (column, descending)
+
+        if key not in self._sortOrders:
+            keys = self.sortKeys(column)
+            order = None
+
+            if keys is not None:
+                if descending:
+                    keys = [-values.astype(np.float64) for values in keys]
+                order = np.lexsort(keys)
+
+            self._sortOrders[key] = order
+
+        return self._sortOrders[key]
@@ -1,3 +1,4 @@
+import numpy as np
 from PyQt5 import QtCore, QtSql
 
 from pydosh import enum, currency
@@ -5,23 +6,106 @@ from pydosh.database import db
 
 
 class TagModel(QtSql.QSqlTableModel):
+    """ The user's tags, read from the database. Record ids and in/out
+        totals for each tag are calculated from the records shown in
+        the record view (see setRecordFilter)
+    """
     tagsChanged = QtCore.pyqtSignal()
+    recordTagsChanged = QtCore.pyqtSignal(list)
     selectionChanged = QtCore.pyqtSignal(list)
 
     def __init__(self, parent=None):
         super(TagModel, self).__init__(parent=parent)
         self.__selectedTagNames = set()
+        self.__tagRows = {}
+        self.__recordIds = []
+        self.__amountsIn = np.empty(0, dtype=np.float64)
+        self.__amountsOut = np.empty(0, dtype=np.float64)
 
         self.setTable('tags')
         self.setEditStrategy(QtSql.QSqlTableModel.OnFieldChange)
         super(TagModel, self).select()
 
-    def setRecordFilter(self, recordIds):
-        """ List of record ids to limit tag data to display
-            If no record ids are given then we still need to set
-            "0" to ensure that no record ids are matched
+    def setRecordFilter(self, store, mask):
+        """ Limit the tag data to the records in store (a RecordStore)
+            that are set in mask. Totals are summed for every tag at once
+            from the store's tag index, without going to the database
         """
-        self.setFilter(','.join([str(rec) for rec in recordIds or [0]]))
+        amountsIn, amountsOut = store.tagTotals(mask)
+        self.__setTotals(store.tagNames, store.tagRecordIds(mask), amountsIn, amountsOut)
+
+    def setRecordFilterClause(self, clause, values):
+        """ Limit the tag data to the records matching clause, an SQL condition on
+            the records table (r) with values to bind, for when the records are
+            filtered on the server and only some of them have been read
+        """
+        query = QtSql.QSqlQuery()
+        query.setForwardOnly(True)
+        query.prepare("""
+               SELECT t.tagname,
+                      ARRAY_TO_STRING(ARRAY_AGG(r.recordid), ','),
+                      COALESCE(SUM(CASE WHEN r.amount > 0 THEN r.amount END), 0),
+                      COALESCE(ABS(SUM(CASE WHEN r.amount < 0 THEN r.amount END)), 0)
+                 FROM tags t
+           INNER JOIN recordtags rt
+                   ON rt.tagid=t.tagid
+           INNER JOIN records r
+                   ON r.recordid=rt.recordid
+           INNER JOIN accounts a
+                   ON a.id=r.accountid
+                WHERE t.userid=?
+                  AND a.userid=?
+                      %s
+             GROUP BY t.tagname
+        """ % ('AND %s' % clause if clause else ''))
+
+        for value in [db.userId, db.userId] + values:
+            query.addBindValue(value)
+
+        if not query.exec_():
+            raise Exception(query.lastError().text())
+
+        tagNames, recordIds, amountsIn, amountsOut = [], [], [], []
+
+        while query.next():
+            tagNames.append(query.value(0))
+            recordIds.append(np.array([int(i) for i in query.value(1).split(',') if i], dtype=np.int64))
+            amountsIn.append(query.value(2))
+            amountsOut.append(query.value(3))
+
+        self.__setTotals(tagNames, recordIds, np.array(amountsIn, dtype=np.float64), np.array(amountsOut, dtype=np.float64))
+
+    def __setTotals(self, tagNames, recordIds, amountsIn, amountsOut):
+        """ Set the record ids and in/out totals of each tag name, and
+            let the views know they have changed
+        """
+        self.__tagRows = dict((name, row) for row, name in enumerate(tagNames))
+        self.__recordIds = recordIds
+        self.__amountsIn = amountsIn
+        self.__amountsOut = amountsOut
+
+        if self.rowCount():
+            self.dataChanged.emit(
+                self.index(0, enum.kTags_RecordIds),
+                self.index(self.rowCount() - 1, enum.kTags_Amount_out)
+            )
+
+    def __tagValue(self, item):
+        """ Returns the record ids, or the in or out total, of the
+            visible records with the item's tag
+        """
+        tagRow = self.__tagRows.get(super(TagModel, self).data(self.index(item.row(), enum.kTags_TagName)))
+
+        if item.column() == enum.kTags_RecordIds:
+            if tagRow is None:
+                return set()
+            return set(self.__recordIds[tagRow].tolist())
+
+        if tagRow is None:
+            return 0.0
+        elif item.column() == enum.kTags_Amount_in:
+            return float(self.__amountsIn[tagRow])
+        return float(self.__amountsOut[tagRow])
 
     def clearSelection(self):
         for row in range(self.rowCount()):
@@ -60,11 +144,10 @@ class TagModel(QtSql.QSqlTableModel):
 
         if role == QtCore.Qt.DisplayRole:
             if item.column() == enum.kTags_RecordIds:
-                tags = set([int(i) for i in super(TagModel, self).data(item).split(',') if i])
-                return tags
+                return self.__tagValue(item)
 
             elif item.column() in (enum.kTags_Amount_in, enum.kTags_Amount_out):
-                amount = super(TagModel, self).data(item)
+                amount = self.__tagValue(item)
                 return currency.formatCurrency(amount) if amount else None
 
         elif role == QtCore.Qt.CheckStateRole and item.column() == enum.kTags_TagName:
@@ -74,7 +157,7 @@ class TagModel(QtSql.QSqlTableModel):
                 return QtCore.Qt.Unchecked
 
         elif role == QtCore.Qt.UserRole and item.column() in (enum.kTags_Amount_in, enum.kTags_Amount_out):
-            return super(TagModel, self).data(item)
+            return self.__tagValue(item)
 
         return super(TagModel, self).data(item, role)
 
@@ -94,24 +177,16 @@ class TagModel(QtSql.QSqlTableModel):
         if not self.tableName():
             return None
 
-        queryFilter = self.filter()
-        queryFilter = 'AND r.recordid IN (%s)' % queryFilter if queryFilter else ''
-
+        # Record ids and totals are filled in by setRecordFilter
         query = """
-               SELECT t.tagid, 
+               SELECT t.tagid,
                       t.tagname,
-                      ARRAY_TO_STRING(ARRAY_AGG(r.recordid), ',') AS recordids,
-                      SUM(CASE WHEN r.amount > 0 THEN r.amount ELSE 0 END) AS amount_in,
-                      ABS(SUM(CASE WHEN r.amount < 0 THEN r.amount ELSE 0 END)) AS amount_out
+                      '' AS recordids,
+                      0.0 AS amount_in,
+                      0.0 AS amount_out
                  FROM tags t
-            LEFT JOIN recordtags rt
-                   ON rt.tagid=t.tagid
-            LEFT JOIN records r 
-                   ON r.recordid=rt.recordid
-                  %s
                 WHERE t.userid=%d
-             GROUP BY t.tagid
-        """ % (queryFilter, db.userId)
+        """ % db.userId
         return query
 
     def headerData (self, section, orientation, role):
@@ -145,13 +220,44 @@ class TagModel(QtSql.QSqlTableModel):
 
 
     def removeTags(self, indexes):
-        for row in [QtCore.QPersistentModelIndex(index).row() for index in indexes]:
+        """ Delete the tags and emit recordTagsChanged with the records they
+            were assigned to, so only those records need to be refreshed
+        """
+        rows = [QtCore.QPersistentModelIndex(index).row() for index in indexes]
+        tagIds = [self.index(row, enum.kTags_TagId).data() for row in rows]
+        recordIds = self.__taggedRecordIds(tagIds)
+
+        for row in rows:
             self.setData(self.index(row, enum.kTags_TagName), QtCore.Qt.Unchecked, QtCore.Qt.CheckStateRole)
             self.removeRow(row, QtCore.QModelIndex())
 
         self.select()
         self.tagsChanged.emit()
 
+        if recordIds:
+            self.recordTagsChanged.emit(recordIds)
+
+    def __taggedRecordIds(self, tagIds):
+        """ Returns the ids of the records with any of tagIds
+        """
+        if not tagIds:
+            return []
+
+        query = QtSql.QSqlQuery()
+        query.setForwardOnly(True)
+
+        if not query.exec_("""
+            SELECT DISTINCT recordid
+                       FROM recordtags
+                      WHERE tagid in (%s)
+            """ % ','.join(str(int(tagId)) for tagId in tagIds)):
+            raise Exception(query.lastError().text())
+
+        recordIds = []
+        while query.next():
+            recordIds.append(query.value(0))
+        return recordIds
+
     def addRecordTags(self, tagId, recordIds):
         if not recordIds:
             return False
@@ -175,8 +281,10 @@ class TagModel(QtSql.QSqlTableModel):
         if not query.execBatch():
             raise Exception(query.lastError().text())
 
-        self.tagsChanged.emit()
-        return self.select()
+        # The tags themselves haven't changed, the totals are updated when
+        # the records are refreshed
+        self.recordTagsChanged.emit(list(recordIds))
+        return True
 
     def removeRecordTags(self, tagId, recordIds):
 
@@ -192,8 +300,10 @@ class TagModel(QtSql.QSqlTableModel):
         if query.lastError().isValid():
             raise Exception(query.lastError().text())
 
-        self.tagsChanged.emit()
-        return self.select()
+        # The tags themselves haven't changed, the totals are updated when
+        # the records are refreshed
+        self.recordTagsChanged.emit(list(recordIds))
+        return True
 
 
 class TagProxyModel(QtCore.QSortFilterProxyModel):
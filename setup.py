@@ -38,7 +38,7 @@ elif sys.platform == 'win32':
     raise Exception('Sorry, Windows is not supported. Please upgrade to Unix')
 else: # Unix
     extra_options = dict(
-        scripts=['scripts/pydosh'],
+        scripts=['scripts/pydosh', 'scripts/pydosh-import'],
             data_files=[
             ('share/applications', ['pydosh.desktop']),
             ('share/pixmaps', ['icons/pydosh.png', 'icons/pydosh.xpm']),
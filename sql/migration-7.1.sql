@@ -0,0 +1,3 @@
+-- Index for reading records in keyset windows (server-side filtering)
+
+CREATE INDEX records_date_idx ON records USING btree (date, recordid);
@@ -487,6 +487,13 @@ CREATE INDEX fki_tags_user_fkey ON tags USING btree (userid);
 CREATE INDEX records_rawdata_idx ON records USING btree (rawdata);
 
 
+--
+-- Name: records_date_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX records_date_idx ON records USING btree (date, recordid);
+
+
 --
 -- Name: accounts_accounttypeid_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -3,6 +3,7 @@
 """
 import os
 import locale
+import tempfile
 import unittest
 
 from pydosh import currency
@@ -55,3 +56,59 @@ class Currency_GB(Currency):
     def test_defaultCurrencyCode(self):
         self.assertEqual(currency.defaultCurrencyCode(), 'GBP')
 
+
+class CurrencyFormatter(unittest.TestCase):
+    conv = {
+        'currency_symbol': u'£', 'mon_decimal_point': '.', 'mon_thousands_sep': ',',
+        'mon_grouping': [3, 3, 0], 'positive_sign': '', 'negative_sign': '-',
+        'frac_digits': 2, 'decimal_point': '.', 'p_cs_precedes': 1, 'n_cs_precedes': 1,
+        'p_sep_by_space': 0, 'n_sep_by_space': 0, 'p_sign_posn': 1, 'n_sign_posn': 1,
+    }
+
+    def test_format(self):
+        formatter = currency.CurrencyFormatter(self.conv)
+        self.assertEqual(formatter.format(23), u'£23.00')
+        self.assertEqual(formatter.format(23000000.00), u'£23,000,000.00')
+        self.assertEqual(formatter.format(-1234.567), u'-£1,234.57')
+
+    def test_formatSymbolAfter(self):
+        conv = dict(self.conv, currency_symbol=u'€', mon_decimal_point=',', mon_thousands_sep='.',
+                    p_cs_precedes=0, n_cs_precedes=0, p_sep_by_space=1, n_sep_by_space=1)
+        formatter = currency.CurrencyFormatter(conv)
+        self.assertEqual(formatter.format(23000.1), u'23.000,10 €')
+        self.assertEqual(formatter.format(-23), u'-23,00 €')
+
+class Locales(unittest.TestCase):
+    def setUp(self):
+        fd, self.cacheFile = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.cacheFile)
+        self.localeConv = currency._localeConv
+        self.probed = []
+
+        def localeConv(loc):
+            self.probed.append(loc)
+            if loc != 'en_GB.utf-8':
+                raise locale.Error('unsupported locale setting')
+            return dict(CurrencyFormatter.conv, int_curr_symbol='GBP ')
+
+        currency._localeConv = localeConv
+
+    def tearDown(self):
+        currency._localeConv = self.localeConv
+        if os.path.exists(self.cacheFile):
+            os.remove(self.cacheFile)
+
+    def test_lazy(self):
+        locales = currency._Locales(self.cacheFile)
+        self.assertEqual(self.probed, [])
+        self.assertEqual(locales.currencyMap, {'GBP': 'en_GB.utf-8'})
+        self.assertEqual(len(self.probed), len(currency._Locales._locales))
+
+    def test_cache(self):
+        currency._Locales(self.cacheFile).currencyMap
+        del self.probed[:]
+
+        locales = currency._Locales(self.cacheFile)
+        self.assertEqual(locales.conventions['GBP']['currency_symbol'], u'£')
+        self.assertEqual(self.probed, [])
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+""" Unit tests for date parser
+"""
+import unittest
+
+from PyQt5 import QtCore
+
+from pydosh.dateparser import DateParser, dateParser
+
+
+class TestDateParser(unittest.TestCase):
+    def assertSameAsQDate(self, text, dateFormat):
+        date = QtCore.QDate.fromString(text, dateFormat)
+        expected = date.toJulianDay() if date.isValid() else None
+        self.assertEqual(DateParser(dateFormat).parse(text), expected, (text, dateFormat))
+
+    def test_numeric(self):
+        for text in ('07/08/2016', '7/8/2016', '31/02/2016', '29/02/2016', '07/08/16', '07/08/2016 ', ''):
+            for dateFormat in ('dd/MM/yyyy', 'd/M/yyyy', 'dd/MM/yy'):
+                self.assertSameAsQDate(text, dateFormat)
+
+    def test_monthName(self):
+        self.assertSameAsQDate('7 Aug 2016', 'd MMM yyyy')
+
+    def test_julianDay(self):
+        self.assertEqual(DateParser('yyyy-MM-dd').parse('2016-08-07'), QtCore.QDate(2016, 8, 7).toJulianDay())
+
+    def test_parseMany(self):
+        parser = DateParser('dd/MM/yyyy')
+        days = parser.parseMany(['07/08/2016', 'bad', '07/08/2016'])
+        self.assertEqual(days, [QtCore.QDate(2016, 8, 7).toJulianDay(), None, QtCore.QDate(2016, 8, 7).toJulianDay()])
+
+    def test_shared(self):
+        self.assertIs(dateParser('dd/MM/yyyy'), dateParser('dd/MM/yyyy'))
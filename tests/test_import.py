@@ -4,8 +4,12 @@
 import os
 import unittest
 import hashlib
+import tempfile
+from unittest import mock
 from datetime import datetime
 
+from PyQt5 import QtCore
+
 from pydosh.models import importModel
 
 
@@ -91,3 +95,174 @@ class TestCsvParse(unittest.TestCase):
 
 
 
+
+
+class TestCsvFileItem(unittest.TestCase):
+    def setUp(self):
+        self.item = importModel.CsvFileItem('statement.csv')
+        self.item.appendRecords([
+            u'07/08/2016,Some Company,£2.40',
+            u'08/08/2016,"Company, Ltd",3.00,extra',
+            u'bad date,Some Company,1.00',
+        ])
+        self.item.formatItem(0, 1, 2, 2, -1, 'dd/MM/yyyy')
+
+    def test_childCount(self):
+        self.assertEqual(self.item.childCount(), 3)
+
+    def test_child(self):
+        rec = self.item.child(1)
+        self.assertIs(rec.parent(), self.item)
+        self.assertEqual(rec.row(), 1)
+        self.assertEqual(rec.dataDict()['desc'], u'Company, Ltd')
+        self.assertEqual(rec.dataDict()['debit'], -3.0)
+
+    def test_numBadRecords(self):
+        self.assertEqual(self.item.numBadRecords(), 1)
+        self.assertEqual(self.item.child(2).data(0, QtCore.Qt.DisplayRole), "Invalid date: 'bad date'")
+
+    def test_setRecordsImported(self):
+        self.item.setRecordsImported({self.item.child(0).checksum()})
+        self.assertEqual(self.item.numRecordsImported(), 1)
+        self.assertEqual(self.item.numRecordsToImport(), 1)
+
+    def test_maxColumns(self):
+        self.item.reset()
+        self.assertEqual(self.item.maxColumns(), 4)
+
+    def test_counters(self):
+        self.item.appendRecords([u'', u'09/08/2016,Other Company,1.00'])
+        self.assertEqual(self.item.numBadRecords(), 2)
+        self.assertEqual(self.item.numRecordsToImport(), 3)
+        self.item.child(4).setDuplicate(True)
+        self.item.child(0).setImported(True)
+        self.assertEqual(self.item.numRecordsToImport(), 1)
+        self.assertEqual(self.item.numRecordsImported(), 1)
+        self.item.child(0).setDuplicate(True)
+        self.assertEqual(self.item.numDuplicateRecords(), 1)
+        self.item.formatItem(0, 1, 2, 2, -1, 'dd/MM/yyyy')
+        self.assertEqual(self.item.numBadRecords(), 2)
+        self.assertEqual(self.item.numRecordsToImport(), 1)
+        self.assertEqual(self.item.numDuplicateRecords(), 1)
+
+    def test_setFormat(self):
+        self.item.formatBlockSize = 2
+        self.item.setFormat((0, 1, 2, 2, 1, 'dd/MM/yyyy'))
+        self.assertTrue(self.item.isPending(2))
+        self.assertEqual(self.item.numBadRecords(), 0)
+        self.assertEqual(self.item.child(2).data(0, QtCore.Qt.DisplayRole), "Invalid date: 'bad date'")
+        self.assertTrue(self.item.isPending(0))
+        self.assertEqual(self.item.numBadRecords(), 1)
+        self.assertEqual(self.item.formatPending(), (0, 2))
+        self.assertIsNone(self.item.formatPending())
+        self.assertEqual(self.item.credit(0), 2.4)
+
+
+class TestMappedLines(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'07/08/2016,Some Company,\xa32.40\r\n\r\n08/08/2016,Other Company,3.00')
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_readCsvFiles(self):
+        batches = list(importModel.readCsvFiles([self.filename], batchSize=2))
+        self.assertEqual([list(ends) for _, ends, _, _ in batches], [[31, 33], [62]])
+        self.assertEqual(batches[-1][3], 100)
+        self.assertEqual(batches[0][2][0], importModel.recordChecksum(u'07/08/2016,Some Company,£2.40'))
+
+    def test_appendLines(self):
+        item = importModel.CsvFileItem(self.filename)
+        for _, ends, checksums, _ in importModel.readCsvFiles([self.filename]):
+            item.appendLines(ends, checksums)
+
+        self.assertEqual(item.childCount(), 3)
+        self.assertEqual(item.rawData(0), u'07/08/2016,Some Company,£2.40')
+        self.assertEqual(item.rawData(2), u'08/08/2016,Other Company,3.00')
+        self.assertTrue(item.isEmpty(1))
+        self.assertEqual(item.numBadRecords(), 1)
+        self.assertEqual(item.maxColumns(), 3)
+
+    def test_appendLinesFlags(self):
+        item = importModel.CsvFileItem(self.filename)
+        for _, ends, checksums, _ in importModel.readCsvFiles([self.filename]):
+            item.appendLines(ends, checksums, [item.kImported, 0, item.kDuplicate])
+
+        self.assertTrue(item.isImported(0))
+        self.assertTrue(item.isDuplicate(2))
+        self.assertEqual(item.numRecordsImported(), 1)
+        self.assertEqual(item.numDuplicateRecords(), 1)
+        self.assertEqual(item.numRecordsToImport(), 0)
+
+
+class TestChecksumSet(unittest.TestCase):
+    def test_add(self):
+        checksums = importModel.ChecksumSet()
+        digests = [hashlib.md5(str(i).encode('utf-8')).digest() for i in range(10)]
+
+        self.assertEqual(checksums.add(digests[:4] + digests[:1]).tolist(), [False] * 4 + [True])
+        self.assertEqual(checksums.add(digests[2:6]).tolist(), [True, True, False, False])
+        self.assertEqual(checksums.add(digests[6:]).tolist(), [False] * 4)
+        self.assertEqual(len(checksums), 10)
+        self.assertEqual(checksums.add(digests[::-1]).tolist(), [True] * 10)
+
+    def test_samePrefix(self):
+        checksums = importModel.ChecksumSet()
+        checksums.add([b'a' * 8 + b'b' * 8, b'a' * 8 + b'd' * 8])
+        self.assertEqual(checksums.add([b'a' * 8 + b'c' * 8, b'a' * 8 + b'd' * 8]).tolist(), [False, True])
+        self.assertEqual(len(checksums), 3)
+
+
+class TestCsvEngines(unittest.TestCase):
+    lines = [
+        u'07/08/2016,"Company, Ltd","2,000.40"',
+        u'08/08/2016,"Unterminated,1.00',
+        u'09/08/2016,Other Company,3.00',
+    ]
+
+    def test_engines(self):
+        for engine in importModel.csvEngines.values():
+            records = engine(self.lines)
+            self.assertEqual(len(records), 3)
+            self.assertEqual(records[0], [u'07/08/2016', u'Company, Ltd', u'2,000.40'])
+            self.assertEqual(records[2], [u'09/08/2016', u'Other Company', u'3.00'])
+
+    def test_decodeRecords(self):
+        results = [
+            importModel.decodeRecords(self.lines, 0, 1, 2, 2, 1, 'dd/MM/yyyy', engine=engine)
+            for engine in importModel.csvEngines
+        ]
+        for dates, credits, debits, errors in results[1:]:
+            self.assertEqual(dates.tolist(), results[0][0].tolist())
+            self.assertEqual(errors, results[0][3])
+
+
+class TestParseAmounts(unittest.TestCase):
+    def test_parseAmounts(self):
+        cents, valid = importModel.parseAmounts([u'2.40', u'"2,000.40"', u'-£2.40', u'', u'-', u'2.40'])
+        self.assertEqual(cents.tolist()[:3], [240, 200040, -240])
+        self.assertEqual(valid.tolist(), [True, True, True, False, False, True])
+
+    def test_blankAmounts(self):
+        # Only the blank and sign only fields should need sanitising
+        junk = mock.Mock(wraps=importModel._AMOUNT_JUNK)
+        with mock.patch.object(importModel, '_AMOUNT_JUNK', junk):
+            cents, valid = importModel.parseAmounts([u'', u'12.50', u'', u'-3', u'-', u''])
+
+        self.assertEqual(sorted(call[0][1] for call in junk.sub.call_args_list), [u'', u'-'])
+        self.assertEqual(cents.tolist(), [0, 1250, 0, -300, 0, 0])
+        self.assertEqual(valid.tolist(), [False, True, False, True, False, False])
+
+    def test_halfCents(self):
+        # Half cents round away from zero, as in the database
+        fields = [u'12.345', u'-12.345', u'0.005', u'-0.005', u'£12.345', u'-£0.005', u'1.125', u'2.675']
+        cents, valid = importModel.parseAmounts(fields)
+        self.assertEqual(cents.tolist(), [1235, -1235, 1, -1, 1235, -1, 113, 268])
+        self.assertTrue(valid.all())
+
+        dates, credits, debits, errors = importModel.decodeRecords(
+            [u'07/08/2016,Some Company,-0.005'], 0, 1, 2, 2, 1, 'dd/MM/yyyy')
+        self.assertEqual(errors, {})
+        self.assertEqual(debits.tolist(), [-0.01])
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+""" Unit tests for record models
+"""
+import operator
+import unittest
+
+from PyQt5 import QtCore
+
+from pydosh import enum
+from pydosh.models import recordModel
+from pydosh.models.recordStore import RecordStore
+
+
+class TestFilterClause(unittest.TestCase):
+    def setUp(self):
+        self.model = recordModel.RecordModel()
+        self.proxy = recordModel.RecordProxyModel()
+        self.proxy.setSourceModel(self.model)
+
+    def test_noFilter(self):
+        self.assertEqual(self.proxy.filterClause(), ('', []))
+
+    def test_dates(self):
+        start = QtCore.QDate(2016, 8, 7)
+        end = QtCore.QDate(2017, 8, 7)
+        self.proxy.setStartDate(start)
+        self.proxy.setEndDate(end)
+        self.assertEqual(self.proxy.filterClause(), ('r.date >= ? AND r.date <= ?', [start, end]))
+
+    def test_accounts(self):
+        self.proxy.setAccountFilter([1, 2])
+        self.assertEqual(self.proxy.filterClause(), ('r.accountid IN (?, ?)', [1, 2]))
+
+    def test_amountOperator(self):
+        self.proxy.setAmountFilter('10', operator.ge)
+        self.assertEqual(self.proxy.filterClause(), ('ABS(r.amount) >= ?', [10.0]))
+
+    def test_badDescription(self):
+        self.proxy.setDescriptionFilter('(')
+        self.assertEqual(self.proxy.filterClause(), ('', []))
+
+    def test_tags(self):
+        self.proxy.setTagFilter(['food', 'rent'])
+        clause, values = self.proxy.filterClause()
+        self.assertIn('t.tagname IN (?, ?)', clause)
+        self.assertEqual(values, ['food', 'rent'])
+
+
+def _record(recordId, day, amount, tags, description):
+    row = [None] * (enum.kRecords_Currency + 1)
+    row[enum.kRecords_RecordId] = recordId
+    row[enum.kRecords_Date] = QtCore.QDate(2017, 8, day)
+    row[enum.kRecords_Amount] = amount
+    row[enum.kRecords_AccountId] = recordId % 2
+    row[enum.kRecords_AccountTypeName] = 'account%d' % (recordId % 2)
+    row[enum.kRecords_Checked] = 0
+    row[enum.kRecords_InsertDate] = QtCore.QDateTime()
+    row[enum.kRecords_Tags] = tags
+    row[enum.kRecords_Description] = description
+    return row
+
+
+class TestRecordStore(unittest.TestCase):
+    def setUp(self):
+        self.store = RecordStore([
+            _record(1, 5, -10.5, 'food##rent', 'Tesco  store'),
+            _record(2, 3, 20.0, '', 'Salary'),
+            _record(3, 9, -3.25, 'food', 'tesco'),
+        ])
+
+    def test_dateMask(self):
+        mask = self.store.dateMask(QtCore.QDate(2017, 8, 4), QtCore.QDate(2017, 8, 9))
+        self.assertEqual(mask.tolist(), [True, False, True])
+
+    def test_descriptionMask(self):
+        self.assertEqual(self.store.descriptionMask('TESCO').tolist(), [True, False, True])
+        self.assertIsNone(self.store.descriptionMask('('))
+
+    def test_amountMask(self):
+        self.assertEqual(self.store.amountMask('10', operator.gt).tolist(), [True, True, False])
+        self.assertEqual(self.store.amountMask('.25').tolist(), [False, False, True])
+
+    def test_tagMask(self):
+        self.assertEqual(self.store.tagMask(['rent']).tolist(), [True, False, False])
+        self.assertEqual(self.store.hasTagsMask(False).tolist(), [False, True, False])
+
+    def test_append(self):
+        self.store.append([_record(4, 1, 1.0, '', 'tesco')])
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(self.store.descriptionMask('^tesco$').tolist(), [False, False, True, True])
+
+    def test_appendWindows(self):
+        for recordId in range(4, 2000):
+            self.store.append([_record(recordId, 1, 1.0, '', 'Tesco' if recordId % 2 else 'Aldi')])
+        self.assertEqual(len(self.store), 1999)
+        self.assertEqual(self.store.recordIds[-2:].tolist(), [1998, 1999])
+        self.assertEqual(len(self.store.descriptions), 5)
+
+        self.store.remove(3, 1997)
+        self.assertEqual(self.store.recordIds.tolist(), [1, 2, 3, 1999])
+        self.assertEqual(self.store.sortOrder(enum.kRecords_Description).tolist(), [1, 3, 0, 2])
+
+    def test_update(self):
+        self.store.update([1], [_record(2, 3, 20.0, 'rent', 'Tesco')])
+        self.assertEqual(self.store.tagMask(['rent']).tolist(), [True, True, False])
+        self.assertEqual(self.store.descriptionMask('tesco').tolist(), [True, True, True])
+
+    def test_remove(self):
+        self.store.remove(0, 1)
+        self.assertEqual(self.store.recordIds.tolist(), [3])
+        self.assertEqual(self.store.descriptionMask('tesco').tolist(), [True])
+
+    def test_tagTotals(self):
+        mask = [True, True, False]
+        amountsIn, amountsOut = self.store.tagTotals(self.store.dateMask() & mask)
+        self.assertEqual(dict(zip(self.store.tagNames, amountsOut.tolist())), {'food': 10.5, 'rent': 10.5})
+        self.assertEqual(amountsIn.tolist(), [0.0, 0.0])
+
+        recordIds = self.store.tagRecordIds(self.store.creditMask(False))
+        self.assertEqual([ids.tolist() for ids in recordIds], [[1, 3], [1]])
+
+    def test_sortOrder(self):
+        self.assertEqual(self.store.sortOrder(enum.kRecords_Amount).tolist(), [0, 2, 1])
+        self.assertEqual(self.store.sortOrder(enum.kRecords_Date, True).tolist(), [2, 0, 1])
+        self.assertIsNone(self.store.sortOrder(enum.kRecords_Currency))
+
+        self.store.append([_record(4, 1, -20.0, '', 'tesco')])
+        self.assertEqual(self.store.sortOrder(enum.kRecords_Amount).tolist(), [3, 0, 2, 1])
+
+    def test_tagIndex(self):
+        self.assertEqual(self.store.tagNames, ['food', 'rent'])
+        self.assertEqual(self.store.tagCounts.tolist(), [2, 0, 1])
+
+        self.store.update([0], [_record(1, 5, -10.5, 'bills', 'Tesco  store')])
+        self.store.append([_record(4, 1, 1.0, 'rent##food', 'tesco')])
+        self.assertEqual(self.store.tagMask(['rent', 'bills']).tolist(), [True, False, False, True])
+        self.assertEqual(self.store.tagCounts.tolist(), [1, 0, 1, 2])
+
+        self.store.remove(1, 2)
+        self.assertEqual(self.store.tagMask(['food']).tolist(), [False, True])
+        self.assertEqual(
+            sorted((int(row), self.store.tagNames[tagId]) for tagId, row in zip(self.store.tagIds, self.store.tagRows)),
+            [(0, 'bills'), (1, 'food'), (1, 'rent')])
+        self.assertEqual(self.store.tagMask(['unknown']).tolist(), [False, False])
+
+
+class _Records(recordModel.RecordModel):
+    """ Record model with rows given by the test rather than read from the database
+    """
+    def __init__(self, rows):
+        super(_Records, self).__init__()
+        self.testRows = rows
+
+    def _RecordModel__readRows(self, lastRow=None):
+        return [row[:] for row in self.testRows]
+
+    def setValue(self, row, column, value):
+        """ Change a value as refreshRecords would
+        """
+        record = self._rows[row][:]
+        record[column] = value
+        self._rows[row] = record
+        self._store.update([row], [record])
+        self.dataChanged.emit(self.index(row, column), self.index(row, column))
+
+    def removeSourceRows(self, rows):
+        self._RecordModel__removeRows(rows)
+
+
+class TestRecordProxyModel(unittest.TestCase):
+    def setUp(self):
+        self.model = _Records([
+            _record(1, 5, -10.5, 'food', 'Tesco'),
+            _record(2, 3, 20.0, '', 'Salary'),
+            _record(3, 9, -3.25, 'food', 'tesco'),
+            _record(4, 1, 7.5, '', 'Refund'),
+            _record(5, 7, -1.0, 'rent', 'Rent'),
+            _record(6, 2, -2.0, '', 'Bus'),
+        ])
+        self.model.select()
+        self.proxy = recordModel.RecordProxyModel()
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setCheckedFilter(False)
+        self.proxy.sort(enum.kRecords_Amount)
+
+    def assertMapping(self):
+        """ The proxy should match a new proxy model, filtered and counted from scratch
+        """
+        expected = recordModel.RecordProxyModel()
+        expected.setSourceModel(self.model)
+        expected.setCheckedFilter(self.proxy._checked)
+        expected.setCreditFilter(self.proxy._creditFilter)
+        expected.sort(self.proxy.sortColumn(), self.proxy.sortOrder())
+
+        self.assertEqual(self.proxy.rowCount(), expected.rowCount())
+
+        for row in range(self.proxy.rowCount()):
+            self.assertEqual(
+                self.proxy.mapToSource(self.proxy.index(row, 0)).row(),
+                expected.mapToSource(expected.index(row, 0)).row()
+            )
+
+        for row in range(self.model.rowCount()):
+            sourceIndex = self.model.index(row, 0)
+            proxyIndex = self.proxy.mapFromSource(sourceIndex)
+            self.assertEqual(proxyIndex.row(), expected.mapFromSource(sourceIndex).row())
+            if proxyIndex.isValid():
+                self.assertEqual(self.proxy.mapToSource(proxyIndex).row(), row)
+
+        inTotal, outTotal = self.proxy.totals()
+        expectedIn, expectedOut = expected.totals()
+        self.assertAlmostEqual(inTotal, expectedIn)
+        self.assertAlmostEqual(outTotal, expectedOut)
+
+    def test_totals(self):
+        self.assertEqual(self.proxy.rowCount(), 6)
+        self.assertEqual(self.proxy.totals(), (27.5, 16.75))
+        self.assertMapping()
+
+    def test_toggleChecked(self):
+        self.model.setValue(2, enum.kRecords_Checked, 1)
+        self.assertEqual(self.proxy.rowCount(), 5)
+        self.assertFalse(self.proxy.mapFromSource(self.model.index(2, 0)).isValid())
+        self.assertEqual(self.proxy.totals(), (27.5, 13.5))
+        self.assertMapping()
+
+        self.model.setValue(2, enum.kRecords_Checked, 0)
+        self.assertEqual(self.proxy.totals(), (27.5, 16.75))
+        self.assertMapping()
+
+    def test_changeAmount(self):
+        self.proxy.setCreditFilter(False)
+        self.assertEqual(self.proxy.totals(), (0.0, 16.75))
+
+        # Largest amounts are first, so this moves to the end and then out of the filter
+        self.model.setValue(5, enum.kRecords_Amount, -30.0)
+        self.assertEqual(self.proxy.mapToSource(self.proxy.index(3, 0)).row(), 5)
+        self.assertEqual(self.proxy.totals(), (0.0, 44.75))
+        self.assertMapping()
+
+        self.model.setValue(5, enum.kRecords_Amount, 4.0)
+        self.assertEqual(self.proxy.rowCount(), 3)
+        self.assertEqual(self.proxy.totals(), (0.0, 14.75))
+        self.assertMapping()
+
+    def test_removeRows(self):
+        self.model.setValue(1, enum.kRecords_Checked, 1)
+        self.model.removeSourceRows([0, 1, 4])
+        self.assertEqual(self.model.rowCount(), 3)
+        self.assertEqual(self.proxy.rowCount(), 3)
+        self.assertEqual(self.proxy.totals(), (7.5, 5.25))
+        self.assertMapping()
+
+    def test_invalidateFilter(self):
+        self.model.setValue(3, enum.kRecords_Checked, 1)
+        self.proxy.setCheckedFilter(True)
+        self.assertEqual(self.proxy.rowCount(), 1)
+        self.assertEqual(self.proxy.totals(), (7.5, 0.0))
+        self.assertMapping()
+
+        self.proxy.invalidateFilter()
+        self.assertMapping()
+
+        self.proxy.setCheckedFilter(None)
+        self.assertEqual(self.proxy.totals(), (27.5, 16.75))
+        self.assertMapping()